@@ -0,0 +1,200 @@
+"""Compare items extracted by slybot and by ported spiders."""
+import json
+import logging
+import os
+import pkgutil
+import sys
+import tempfile
+
+from collections import Counter, OrderedDict
+from importlib import import_module
+from timeit import default_timer
+
+import six
+
+from scrapy.http import HtmlResponse
+from six.moves.urllib.request import pathname2url
+from slybot.utils import htmlpage_from_response
+
+from .porter import load_project_data, port_project
+from .utils import class_name
+try:
+    from itemadapter import ItemAdapter
+except ImportError:
+    ItemAdapter = None
+log = logging.getLogger(__name__)
+PROJECT_NAME = 'portia_compare'
+FIELD_RESULTS = ('same', 'different', 'missing', 'extra')
+
+
+def load_corpus(corpus_dir, spider_name=None):
+    """Load html pages as responses from `corpus_dir`.
+
+    Pages for a single spider are read from a directory named after the
+    spider if there is one. Page urls are read from a `urls.json` file
+    mapping file names to urls, or else are the page's file url.
+    """
+    if spider_name is not None:
+        spider_dir = os.path.join(corpus_dir, spider_name)
+        if os.path.isdir(spider_dir):
+            corpus_dir = spider_dir
+    urls = {}
+    urls_path = os.path.join(corpus_dir, 'urls.json')
+    if os.path.exists(urls_path):
+        with open(urls_path) as f:
+            urls = json.load(f)
+    responses = []
+    for filename in sorted(os.listdir(corpus_dir)):
+        if not filename.endswith(('.html', '.htm')):
+            continue
+        path = os.path.join(corpus_dir, filename)
+        url = urls.get(filename)
+        if url is None:
+            url = 'file:' + pathname2url(os.path.abspath(path))
+        with open(path, 'rb') as f:
+            body = f.read()
+        responses.append(HtmlResponse(url, body=body))
+    return responses
+
+
+def load_spider_classes(archive, dir_name):
+    """Import the spider classes from a ported project archive by name."""
+    sys.path.insert(0, archive)
+    base = import_module('{}.utils.spiders'.format(dir_name))
+    package = import_module('{}.spiders'.format(dir_name))
+    classes = {}
+    for _, module_name, _ in pkgutil.iter_modules(package.__path__):
+        module = import_module('{}.{}'.format(package.__name__, module_name))
+        for value in vars(module).values():
+            if (isinstance(value, type) and
+                    issubclass(value, base.BasePortiaSpider) and
+                    value.__module__ == module.__name__):
+                classes[value.name] = value
+    return classes
+
+
+def unload_modules(package):
+    """Remove `package` and its submodules from the imported modules."""
+    for name in list(sys.modules):
+        if name == package or name.startswith(package + '.'):
+            del sys.modules[name]
+
+
+def slybot_items(spider, response):
+    htmlpage = htmlpage_from_response(response, _add_tagids=True)
+    return spider.plugins[0].extract_items(htmlpage, response)[0]
+
+
+def ported_items(spider, response):
+    return list(spider.parse_item(response))
+
+
+def item_fields(item):
+    """Get the fields of an item, ignoring slybot's metadata fields."""
+    if ItemAdapter is not None:
+        item = ItemAdapter(item).asdict()
+    return {k: _normalize(v) for k, v in dict(item).items()
+            if not k.startswith('_')}
+
+
+def _normalize(value):
+    # Slybot keeps lists of values where ported spiders join them
+    if isinstance(value, (list, tuple)):
+        return u' '.join(_normalize(v) for v in value)
+    if value is None:
+        return value
+    return six.text_type(value).strip()
+
+
+def compare_items(expected, extracted, results):
+    """Count how each field of `extracted` compares to `expected`."""
+    for index in range(max(len(expected), len(extracted))):
+        original = expected[index] if index < len(expected) else {}
+        ported = extracted[index] if index < len(extracted) else {}
+        for field in set(original) | set(ported):
+            if field not in ported:
+                result = 'missing'
+            elif field not in original:
+                result = 'extra'
+            elif original[field] == ported[field]:
+                result = 'same'
+            else:
+                result = 'different'
+            results.setdefault(field, Counter())[result] += 1
+
+
+def compare_spider(spider, spider_class, responses):
+    """Extract items from `responses` with both versions of a spider."""
+    ported = spider_class()
+    results = {'pages': len(responses), 'slybot_time': 0.0,
+               'ported_time': 0.0, 'slybot_items': 0, 'ported_items': 0,
+               'fields': {}}
+    for response in responses:
+        start = default_timer()
+        expected = slybot_items(spider, response)
+        results['slybot_time'] += default_timer() - start
+        start = default_timer()
+        extracted = ported_items(ported, response)
+        results['ported_time'] += default_timer() - start
+        results['slybot_items'] += len(expected)
+        results['ported_items'] += len(extracted)
+        compare_items([item_fields(i) for i in expected],
+                      [item_fields(i) for i in extracted], results['fields'])
+    return results
+
+
+def compare_project(storage, corpus_dir, spider_names=None, **options):
+    """Compare slybot and ported spiders over the pages in `corpus_dir`.
+
+    `options` are passed to `port_project`. Returns the results for each
+    spider ordered by spider name.
+    """
+    schemas, extractors, spiders = load_project_data(storage)
+    if spider_names:
+        spiders = {k: v for k, v in spiders.items() if k in spider_names}
+    project = port_project(PROJECT_NAME, schemas, spiders, extractors,
+                           **options)
+    dir_name = class_name(PROJECT_NAME)
+    fd, archive = tempfile.mkstemp(suffix='.zip')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(project.read())
+        spider_classes = load_spider_classes(archive, dir_name)
+        report = OrderedDict()
+        for name in sorted(spiders):
+            if name not in spider_classes:
+                log.warning('No ported spider found for "%s"', name)
+                continue
+            responses = load_corpus(corpus_dir, name)
+            log.info('Comparing spider "%s" on %d pages', name,
+                     len(responses))
+            report[name] = compare_spider(spiders[name][0],
+                                          spider_classes[name], responses)
+        return report
+    finally:
+        if archive in sys.path:
+            sys.path.remove(archive)
+        # Modules imported from the archive can't be reused once it's removed
+        unload_modules(dir_name)
+        os.remove(archive)
+
+
+def format_report(report):
+    """Render a comparison report as text."""
+    lines = []
+    for name, results in report.items():
+        lines.append('Spider "{}": {} pages'.format(name, results['pages']))
+        for version in ('slybot', 'ported'):
+            elapsed = results['{}_time'.format(version)]
+            rate = results['pages'] / elapsed if elapsed else 0.0
+            lines.append('  {:<8}{:>6} items {:>10.4f}s {:>10.1f} pages/s'
+                         .format(version, results['{}_items'.format(version)],
+                                 elapsed, rate))
+        if results['slybot_time'] and results['ported_time']:
+            lines.append('  speedup {:.2f}x'.format(
+                results['slybot_time'] / results['ported_time']))
+        for field in sorted(results['fields']):
+            counts = results['fields'][field]
+            lines.append('  {:<24}'.format(field) + ' '.join(
+                '{}={}'.format(r, counts[r]) for r in FIELD_RESULTS))
+    return '\n'.join(lines)
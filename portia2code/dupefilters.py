@@ -0,0 +1,96 @@
+import logging
+import math
+import os
+
+from scrapy.dupefilters import RFPDupeFilter
+from scrapy.utils.job import job_dir
+
+
+class BloomFilter(object):
+    """Fixed size set of strings that may report false positives.
+
+    Sized so that up to `capacity` keys are added with a probability of
+    `error_rate` that a key not added is reported as present. Keys must be
+    hex digests of at least 32 characters, such as request fingerprints,
+    which are used directly as the hash values.
+    """
+    def __init__(self, capacity, error_rate, bits=None):
+        num_bits = int(math.ceil(
+            -capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.num_bits = max(num_bits, 8)
+        self.num_hashes = max(int(round(
+            self.num_bits / float(capacity) * math.log(2))), 1)
+        size = (self.num_bits + 7) // 8
+        if bits is None or len(bits) != size:
+            bits = bytearray(size)
+        self.bits = bits
+
+    def add(self, key):
+        """Add `key`, returning True if it may have been added before."""
+        bits = self.bits
+        seen = True
+        for position in self._positions(key):
+            index, mask = position >> 3, 1 << (position & 7)
+            if not bits[index] & mask:
+                bits[index] |= mask
+                seen = False
+        return seen
+
+    def __contains__(self, key):
+        bits = self.bits
+        return all(bits[position >> 3] & (1 << (position & 7))
+                   for position in self._positions(key))
+
+    def _positions(self, key):
+        first, second = int(key[:16], 16), int(key[16:32], 16) | 1
+        return ((first + i * second) % self.num_bits
+                for i in range(self.num_hashes))
+
+
+class BloomDupeFilter(RFPDupeFilter):
+    """Request fingerprint duplicates filter using a fixed amount of memory.
+
+    Enable it in a project with::
+
+        DUPEFILTER_CLASS = 'project.utils.dupefilters.BloomDupeFilter'
+
+    Memory use depends on the `PORTIA_DUPEFILTER_CAPACITY` and
+    `PORTIA_DUPEFILTER_ERROR_RATE` settings rather than the number of
+    requests seen. Once more requests than the capacity have been seen some
+    new requests may be dropped as duplicates. When `JOBDIR` is set the
+    filter is saved to `requests.bloom` in it so that crawls can be resumed.
+    """
+    default_capacity = 10000000
+    default_error_rate = 0.0001
+
+    def __init__(self, path=None, debug=False, capacity=None,
+                 error_rate=None):
+        self.file = None
+        self.path = path
+        self.logdupes = True
+        self.debug = debug
+        self.logger = logging.getLogger(__name__)
+        bits = None
+        if path:
+            filename = os.path.join(path, 'requests.bloom')
+            if os.path.exists(filename):
+                with open(filename, 'rb') as f:
+                    bits = bytearray(f.read())
+        self.fingerprints = BloomFilter(capacity or self.default_capacity,
+                                        error_rate or self.default_error_rate,
+                                        bits)
+
+    @classmethod
+    def from_settings(cls, settings):
+        return cls(job_dir(settings), settings.getbool('DUPEFILTER_DEBUG'),
+                   settings.getint('PORTIA_DUPEFILTER_CAPACITY'),
+                   settings.getfloat('PORTIA_DUPEFILTER_ERROR_RATE'))
+
+    def request_seen(self, request):
+        return self.fingerprints.add(self.request_fingerprint(request))
+
+    def close(self, reason):
+        if self.path:
+            filename = os.path.join(self.path, 'requests.bloom')
+            with open(filename, 'wb') as f:
+                f.write(self.fingerprints.bits)
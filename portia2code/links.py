@@ -0,0 +1,52 @@
+import re
+import six
+
+from scrapy.linkextractors import LinkExtractor
+
+# Patterns that change meaning or fail to compile inside a larger pattern
+_UNCOMBINABLE_RE = re.compile(r'\\[1-9]|\(\?P[=<]|\(\?[aiLmsux]+\)')
+_DEFAULT_FLAGS = re.compile('').flags
+
+
+def compile_patterns(patterns):
+    r"""Combine `patterns` into as few compiled regexes as possible.
+
+    Returns a list of compiled regexes such that a string is matched by one
+    of them if it is matched by one of `patterns`. Patterns are joined into
+    a single alternation except those using backreferences, named groups,
+    inline flags or flags of their own, which are compiled separately.
+
+    >>> [r.pattern for r in compile_patterns([r'/item/\d+', '/product/'])]
+    ['(?:/item/\\d+)|(?:/product/)']
+    """
+    combined, separate = [], []
+    for pattern in patterns:
+        flags = _DEFAULT_FLAGS
+        if not isinstance(pattern, six.string_types):
+            pattern, flags = pattern.pattern, pattern.flags
+        if flags != _DEFAULT_FLAGS or _UNCOMBINABLE_RE.search(pattern):
+            separate.append(re.compile(pattern, flags))
+        else:
+            combined.append(pattern)
+    if len(combined) == 1:
+        return [re.compile(combined[0])] + separate
+    if combined:
+        try:
+            regex = re.compile(
+                '|'.join('(?:{})'.format(p) for p in combined))
+        except (re.error, OverflowError):
+            return [re.compile(p) for p in combined] + separate
+        return [regex] + separate
+    return separate
+
+
+class PatternLinkExtractor(LinkExtractor):
+    """`LinkExtractor` testing links against combined allow/deny patterns.
+
+    Extracts the same links as `LinkExtractor` while matching each link
+    against one regex instead of every pattern in turn.
+    """
+    def __init__(self, *args, **kwargs):
+        super(PatternLinkExtractor, self).__init__(*args, **kwargs)
+        self.allow_res = compile_patterns(self.allow_res)
+        self.deny_res = compile_patterns(self.deny_res)
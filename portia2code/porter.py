@@ -1,7 +1,11 @@
 """Convert a Portia project into a python scrapy project."""
-import imp
+import json
 import logging
+import marshal
 import os
+import posixpath
+import struct
+import sys
 import string
 import zipfile
 
@@ -10,42 +14,81 @@ from inspect import getsource
 from itertools import chain
 from os.path import join
 
+import portia2code.dupefilters
+import portia2code.links
+import portia2code.parser
 import portia2code.spiders
+import portia2code.starturls
 import scrapy
 
 from six import BytesIO
+try:
+    from importlib.util import MAGIC_NUMBER, source_hash
+except ImportError:
+    # Hash-based bytecode needs python 3.7
+    MAGIC_NUMBER = source_hash = None
 
 from autopep8 import fix_code
 from scrapy.settings import Settings
 from scrapy.utils.template import string_camelcase
-from slybot.utils import SpiderLoader
+from slybot.utils import SpiderLoader, Storage
 from slybot.spider import IblSpider
-from slybot.starturls import fragment_generator, feed_generator
 from slybot.utils import decode
 from w3lib.util import to_unicode, to_bytes
 
 from .samples import ItemBuilder
 from .templates import (
-    ITEM_CLASS, ITEM_FIELD, ITEMS_IMPORTS, RULES, SPIDER_CLASS, SPIDER_FILE,
-    SETUP
+    ATTRS_ITEM_CLASS, ATTRS_ITEM_FIELD, CLASS_ATTRIBUTE, ITEM_CLASS,
+    ITEM_FIELD, ITEMS_IMPORTS, ITEMS_PACKAGE, LINK_OPTION, PORTIA_ITEM,
+    PORTIA_ITEM_IMPORT, RULES, SPIDER_CLASS, SPIDER_FILE, SETUP
 )
-from .utils import (PROCESSOR_TYPES, _validate_identifier, _clean, class_name,
-                    item_field_name, merge_sources)
+from .utils import (PROCESSOR_TYPES, ItemClass, _validate_identifier, _clean,
+                    build_container_query, build_container_tests,
+                    build_page_marker, class_name, item_field_name,
+                    learn_link_patterns, module_name,
+                    referenced_item_classes, url_shape_pattern)
 log = logging.getLogger(__name__)
 TEMPLATES_PATH = (scrapy.__path__[0], 'templates', 'project')
 OPTIONS = {
     'aggressive': 2
 }
+ITEM_CLASS_TYPES = ('scrapy', 'attrs')
+BLOOM_DUPEFILTER = '{}.utils.dupefilters.BloomDupeFilter'
+# Earliest date that can be stored in a zip file
+FIXED_DATE_TIME = (1980, 1, 1, 0, 0, 0)
+CRAWL_ORDER_SETTINGS = {
+    'breadth': {
+        'DEPTH_PRIORITY': 1,
+        'SCHEDULER_DISK_QUEUE': 'scrapy.squeues.PickleFifoDiskQueue',
+        'SCHEDULER_MEMORY_QUEUE': 'scrapy.squeues.FifoMemoryQueue'
+    },
+    'depth': {
+        'DEPTH_PRIORITY': -1
+    }
+}
+NUMERIC_FIELD_TYPES = frozenset({'number', 'price'})
 
 
 class UpdatingZipFile(zipfile.ZipFile):
-    """ZipFile that buffers writes so that each file is only written once."""
+    """ZipFile that buffers writes so that each file is only written once.
+
+    Buffered files are written in order of their paths each time the
+    archive is finalized and all files are listed in order of their paths
+    once it is closed. When `date_time` is given every file is stamped
+    with it so that the same files always give the same archive.
+    `compresslevel` sets the level of compression used and with `bytecode`
+    python modules are written with compiled bytecode.
+    """
 
     def __init__(self, file, mode="r", compression=zipfile.ZIP_STORED,
-                 allowZip64=False):
+                 allowZip64=False, compresslevel=None, date_time=None,
+                 bytecode=False):
         super(UpdatingZipFile, self).__init__(file, mode, compression,
                                               allowZip64)
         self._files = {}
+        self._compresslevel = compresslevel
+        self.date_time = date_time
+        self.bytecode = bytecode
 
     _writestr = zipfile.ZipFile.writestr
 
@@ -55,27 +98,161 @@ class UpdatingZipFile(zipfile.ZipFile):
 
     def finalize(self):
         """Write all buffered files to archive."""
-        for zinfo, contents, compress_type in self._files.values():
-            self._writestr(zinfo, to_bytes(contents), compress_type)
+        for name in sorted(self._files):
+            zinfo, contents, compress_type = self._files[name]
+            contents = to_bytes(contents)
+            if self.date_time is not None:
+                zinfo.date_time = self.date_time
+            self._write_file(zinfo, contents, compress_type)
+            if self.bytecode and name.endswith('.py'):
+                self._write_bytecode(zinfo, contents, compress_type)
         self._files = {}
 
+    def close(self):
+        """Write buffered files and list all files in order of path."""
+        if self._files:
+            self.finalize()
+        # Entries keep their offsets so only the directory is reordered
+        self.filelist.sort(key=lambda zinfo: zinfo.orig_filename)
+        super(UpdatingZipFile, self).close()
+
+    def _write_file(self, zinfo, contents, compress_type):
+        if self._compresslevel is None:
+            self._writestr(zinfo, contents, compress_type)
+        else:
+            self._writestr(zinfo, contents, compress_type,
+                           compresslevel=self._compresslevel)
+
+    def _write_bytecode(self, zinfo, contents, compress_type):
+        path = zinfo.orig_filename
+        try:
+            bytecode = compile_bytecode(contents, path)
+        except SyntaxError as e:
+            log.warning('Not compiling "%s": %s', path, e)
+            return
+        dirname, filename = posixpath.split(path)
+        pyc = posixpath.join(dirname, '__pycache__', '{}.{}.pyc'.format(
+            filename[:-len('.py')], sys.implementation.cache_tag))
+        pycinfo = zipfile.ZipInfo(pyc, zinfo.date_time)
+        pycinfo.external_attr = zinfo.external_attr
+        self._write_file(pycinfo, bytecode, compress_type)
+
+
+def compile_bytecode(source, path):
+    """Compile `source` to the contents of a hash-based `.pyc` file.
+
+    Hash-based files stay valid however the archive's files are extracted
+    and only need the source to be hashed when imported. They can only be
+    imported by the version of python that created them.
+    """
+    code = compile(source, path, 'exec', dont_inherit=True)
+    flags = 0b11  # Hash-based and checked against the source
+    return b''.join((MAGIC_NUMBER, struct.pack('<I', flags),
+                     source_hash(source), marshal.dumps(code)))
+
+
+class ZipStorage(Storage):
+    """Storage reading a Portia project from a zip archive.
+
+    Files are read from the archive when opened rather than extracted. The
+    project may be at the root of the archive or in a directory within it.
+    The archive is closed by `close` or when used as a context manager.
+    """
+
+    def __init__(self, archive):
+        self.archive = zipfile.ZipFile(archive)
+        self._dirs = {}
+        names = [n for n in self.archive.namelist() if not n.endswith('/')]
+        project_files = [n for n in names
+                         if posixpath.basename(n) == 'project.json']
+        if project_files:
+            self.base_path = posixpath.dirname(min(project_files, key=len))
+        else:
+            self.base_path = ''
+        for name in names:
+            parts = name.split('/')
+            for i in range(len(parts)):
+                self._dirs.setdefault('/'.join(parts[:i]), set()).add(
+                    parts[i])
+
+    def rel_path(self, *args):
+        return '/'.join(args)
+
+    def _path(self, *args):
+        return posixpath.join(self.base_path, self.rel_path(*args))
+
+    def isdir(self, *args, **kwargs):
+        return self._path(*args).rstrip('/') in self._dirs
+
+    def listdir(self, *args, **kwargs):
+        path = self._path(*args).rstrip('/')
+        try:
+            return sorted(self._dirs[path])
+        except KeyError:
+            raise OSError('No such directory in archive: "%s"' % path)
+
+    def open(self, *args, **kwargs):
+        """Read a file from the archive."""
+        raw = kwargs.pop('raw', False)
+        data = self.archive.read(self._path(*args)).decode('utf-8')
+        return data if raw else json.loads(data)
+
+    def close(self):
+        self.archive.close()
+
+    def __enter__(self):
+        return self
 
-def load_project_data(storage):
-    """Load project data using provided open_func and project directory."""
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def load_project_data(storage, lazy=False):
+    """Load project data using provided open_func and project directory.
+
+    With `lazy` spiders are returned as an iterator that loads each spider
+    when it is reached instead of a dict holding every spider at once.
+    Storages with a `close` method, such as `ZipStorage`, are closed once
+    every spider has been loaded.
+    """
     # Load items and extractors from project
 
     schemas = storage.open('items.json')
     extractors = storage.open('extractors.json')
 
     # Load spiders and templates
+    spiders = _closing_when_done(storage,
+                                 iter_spiders(storage, schemas, extractors))
+    if not lazy:
+        spiders = dict(spiders)
+    return schemas, extractors, spiders
+
+
+def _closing_when_done(storage, spiders):
+    try:
+        for spider in spiders:
+            yield spider
+    finally:
+        close = getattr(storage, 'close', None)
+        if close is not None:
+            close()
+
+
+def iter_spiders(storage, schemas, extractors, names=None):
+    """Load spiders one at a time, yielding their names and definitions.
+
+    Only the spiders in `names` are loaded when it is given.
+    """
     spider_loader = SpiderLoader(storage)
-    spiders = {}
-    for spider_name in spider_loader.spider_names:
-        spider = spider_loader[spider_name]
+    spider_names = spider_loader.spider_names
+    if names is not None:
+        spider_names = spider_names & set(names)
+    for spider_name in sorted(spider_names):
+        # Bypass the loader's cache so that each spider can be released
+        spider = spider_loader.load_spider(spider_name)
         crawler = IblSpider(spider_name, spider, schemas, extractors,
                             Settings())
-        spiders[spider_name] = (crawler, spider)
-    return schemas, extractors, spiders
+        yield spider_name, (crawler, spider)
 
 
 def write_to_archive(archive, project_name, files):
@@ -89,7 +266,7 @@ def write_to_archive(archive, project_name, files):
         filepath = join(project_name, filepath)
         fileinfo = zipfile.ZipInfo(filepath, tstamp)
         fileinfo.external_attr = 0o666 << 16
-        archive.writestr(fileinfo, contents, zipfile.ZIP_DEFLATED)
+        archive.writestr(fileinfo, contents, archive.compression)
 
 
 def find_files(project_name):
@@ -129,8 +306,22 @@ def start_scrapy_project(project_name):
     return out_files
 
 
-def create_schemas_classes(items):
+def create_item_classes(items):
+    """Map schema ids to the item classes that will be generated for them."""
+    item_classes = {'_PortiaItem': ItemClass('PortiaItem')}
+    for item_id, item in items.items():
+        item_name = class_name(item.get('name', item_id))
+        if _validate_identifier(item_name):
+            item_classes[item_id] = ItemClass('{}Item'.format(item_name))
+    return item_classes
+
+
+def create_schemas_classes(items, item_class='scrapy'):
     """Create schemas and fields from definitions."""
+    if item_class == 'attrs':
+        class_template = ATTRS_ITEM_CLASS
+    else:
+        class_template = ITEM_CLASS
     item_classes, item_names = [], {}
     for item_id, item in items.items():
         item_name = class_name(item.get('name', item_id))
@@ -139,17 +330,21 @@ def create_schemas_classes(items):
                 'Skipping item with id "%s", name "%s" is not a valid '
                 'identifier' % (item_id, item_name))
             continue
-        item_fields = ''.join(create_fields(item['fields']))
+        item_fields = ''.join(create_fields(item['fields'], item_class))
         if not item_fields:
             item_fields = 'pass\n'.rjust(9)
         item_classes.append(
-            ITEM_CLASS(name=item_name, fields=item_fields))
+            class_template(name=item_name, fields=item_fields))
         item_names[item_id] = item_name
     return item_classes, item_names
 
 
-def create_fields(item_fields):
-    """"Create fields from definitions."""
+def create_fields(item_fields, item_class='scrapy'):
+    """"Create fields from definitions.
+
+    With the `attrs` item class numeric fields are typed and keep their value
+    as a number instead of being joined into a string.
+    """
     fields = []
     for field_id, field in item_fields.items():
         name = item_field_name(field.get('name', field_id))
@@ -162,9 +357,17 @@ def create_fields(item_fields):
             continue
         field_type = field.get('type', 'text')
         input_processor = repr(PROCESSOR_TYPES.get(field_type, 'lambda x: x'))
-        output_processor = 'Join()'
-        fields.append(ITEM_FIELD(name=name, input=input_processor,
-                                 output=output_processor))
+        if item_class != 'attrs':
+            fields.append(ITEM_FIELD(name=name, input=input_processor,
+                                     output='Join()'))
+        elif field_type in NUMERIC_FIELD_TYPES:
+            fields.append(ATTRS_ITEM_FIELD(name=name, type='float',
+                                           input=input_processor,
+                                           output='FirstNumber()'))
+        else:
+            fields.append(ATTRS_ITEM_FIELD(name=name, type='str',
+                                           input=input_processor,
+                                           output='Join()'))
     return fields
 
 
@@ -172,25 +375,82 @@ def create_library_files():
     """Write utilities needed to run spiders."""
     return [
         ('utils/__init__.py', ''),
+        ('utils/dupefilters.py', getsource(portia2code.dupefilters)),
+        ('utils/links.py', getsource(portia2code.links)),
         ('utils/parser.py', getsource(portia2code.parser)),
         ('utils/processors.py', getsource(portia2code.processors)),
         ('utils/spiders.py', getsource(portia2code.spiders)),
-        ('utils/starturls.py', merge_sources(fragment_generator,
-                                             feed_generator))
+        ('utils/starturls.py', getsource(portia2code.starturls))
     ]
 
 
-def create_schemas(items):
+def create_schemas(items, item_class='scrapy'):
     """Create and write schemas from definitions."""
-    schema_classes, schema_names = create_schemas_classes(items)
-    items_py = '\n'.join(chain([ITEMS_IMPORTS], schema_classes)).strip()
+    schema_classes, schema_names = create_schemas_classes(items, item_class)
+    imports = ITEMS_IMPORTS(package='.',
+                            attrs_import=_attrs_import(item_class),
+                            portia_item=PORTIA_ITEM)
+    items_py = '\n'.join(chain([imports], schema_classes)).strip()
     items_py = fix_code(to_unicode(items_py), OPTIONS)
     return items_py, schema_names
 
 
+def create_item_modules(items, item_class='scrapy'):
+    """Create an items package with a module for each schema.
+
+    Item classes are imported from their modules when they are first used
+    so that processes only create the classes that they use.
+    """
+    base = ITEMS_IMPORTS(package='..', attrs_import='',
+                         portia_item=PORTIA_ITEM)
+    files = [('items/portia_item.py',
+              fix_code(to_unicode(base.strip()), OPTIONS))]
+    modules = {'PortiaItem': 'portia_item'}
+    imports = ITEMS_IMPORTS(package='..',
+                            attrs_import=_attrs_import(item_class),
+                            portia_item=PORTIA_ITEM_IMPORT)
+    schema_names = {}
+    for item_id in sorted(items):
+        schema_classes, names = create_schemas_classes(
+            {item_id: items[item_id]}, item_class)
+        if not names:
+            continue
+        schema_names.update(names)
+        name = '{}Item'.format(names[item_id])
+        module = module_name(name)
+        suffix = 1
+        while module in modules.values():
+            suffix += 1
+            module = '{}_{}'.format(module_name(name), suffix)
+        modules[name] = module
+        code = '\n'.join(chain([imports], schema_classes)).strip()
+        files.append(('items/{}.py'.format(module),
+                      fix_code(to_unicode(code), OPTIONS)))
+    package = ITEMS_PACKAGE(modules=format_settings(modules))
+    files.append(('items/__init__.py', fix_code(to_unicode(package),
+                                                OPTIONS)))
+    return files, schema_names
+
+
+def _attrs_import(item_class):
+    return 'import attr\n' if item_class == 'attrs' else ''
+
+
+def format_settings(settings):
+    """Render a dict literal with a stable key order."""
+    return '{%s}' % ', '.join('%r: %r' % (key, settings[key])
+                              for key in sorted(settings))
+
+
 def create_spider(name, spider, spec, schemas, extractors, items,
-                  selector='css'):
-    """Convert a slybot spider into scrapy code."""
+                  selector='css', group_selectors=False, settings=None,
+                  canonicalize=False, referenced=None):
+    """Convert a slybot spider into scrapy code.
+
+    `settings` are emitted as the spider's `custom_settings` and
+    `canonicalize` makes its link extractor canonicalize extracted URLs.
+    The item classes used by the spider are added to `referenced`.
+    """
     cls_name = class_name(name)
     start_urls = []
     for url in spider._start_urls.normalize():
@@ -202,79 +462,189 @@ def create_spider(name, spider, spec, schemas, extractors, items,
     start_urls = '[%s]' % ',\n'.join(start_urls)
 
     allowed = spider.allowed_domains
+    template_urls = [t.get('url') for t in spec.get('templates', [])]
     crawling_options = spec.get('links_to_follow')
     allow, deny = '', ''
+    link_extractor = 'LinkExtractor'
     if crawling_options == 'patterns':
+        # Match links against all patterns at once
+        link_extractor = 'PatternLinkExtractor'
         if spec.get('follow_patterns'):
             allow = ', '.join((repr(s) for s in spec['follow_patterns']))
         if spec.get('exclude_patterns'):
             deny = ','.join((repr(s) for s in spec['exclude_patterns']))
     elif crawling_options == 'none':
         deny = "'.*'"
+    elif crawling_options == 'auto':
+        follow, exclude = learn_link_patterns(
+            template_urls,
+            [u.get('url') for u in spider._start_urls.normalize()])
+        if follow:
+            link_extractor = 'PatternLinkExtractor'
+            allow = ', '.join(repr(s) for s in follow)
+            deny = ', '.join(repr(s) for s in exclude)
+        else:
+            allow = "'.*'"
     else:
         allow = "'.*'"
-    # TODO: Add support for auto
-    rules = RULES(allow=allow, deny=deny)
+    link_options = ''
+    if canonicalize:
+        link_options = LINK_OPTION(name='canonicalize', value=True)
+    rules = RULES(link_extractor=link_extractor, allow=allow, deny=deny,
+                  link_options=link_options)
     item_imports = ItemBuilder(
-        schemas, extractors, items, items['_PortiaItem'], selector).extract(
-        spider.plugins[0].extractors
-    )
+        schemas, extractors, items, items['_PortiaItem'], selector,
+        group_selectors).extract(spider.plugins[0].extractors)
+    if referenced is not None:
+        referenced.update(referenced_item_classes(item_imports))
+    attributes = ''
+    container_tests = build_container_tests(item_imports)
+    if container_tests:
+        # Find the containers of all samples with a single query
+        attributes += CLASS_ATTRIBUTE(
+            name='container_query',
+            value=repr(build_container_query(item_imports)))
+        attributes += CLASS_ATTRIBUTE(name='container_tests',
+                                      value=format_settings(container_tests))
+    else:
+        page_marker = build_page_marker(item_imports)
+        if page_marker:
+            attributes += CLASS_ATTRIBUTE(name='page_marker',
+                                          value=repr(page_marker))
+    if settings:
+        attributes += CLASS_ATTRIBUTE(name='custom_settings',
+                                      value=format_settings(settings))
+    item_url_patterns = sorted(set(url_shape_pattern(url)
+                                   for url in template_urls if url))
+    if item_url_patterns:
+        attributes += CLASS_ATTRIBUTE(name='item_url_patterns',
+                                      value=repr(item_url_patterns))
     return SPIDER_CLASS(
         class_name=cls_name, name=name, allowed_domains=repr(allowed),
-        start_urls=start_urls, rules=rules, items=item_imports
+        start_urls=start_urls, attributes=attributes, rules=rules,
+        items=item_imports
     )
 
 
-def create_spiders(spiders, schemas, extractors, items, selector='css'):
+def create_spiders(spiders, schemas, extractors, items, selector='css',
+                   group_selectors=False, settings=None, canonicalize=False):
     """Create all spiders from slybot spiders."""
+    return list(iter_spider_files(spiders, schemas, extractors, items,
+                                  selector, group_selectors, settings,
+                                  canonicalize))
+
+
+def iter_spider_files(spiders, schemas, extractors, items, selector='css',
+                      group_selectors=False, settings=None,
+                      canonicalize=False):
+    """Create spiders one at a time, yielding their paths and code.
+
+    `spiders` is a dict or an iterable of `(name, (spider, spec))` pairs.
+    Spiders whose names are cleaned to the same file name are given a
+    numbered suffix.
+    """
+    if hasattr(spiders, 'items'):
+        spiders = spiders.items()
+    filenames = set()
+    for name, (spider, spec) in spiders:
+        filename = spider_filename(name, filenames)
+        code = create_spider_file(name, spider, spec, schemas, extractors,
+                                  items, selector, group_selectors, settings,
+                                  canonicalize)
+        yield filename, code
+
+
+def spider_filename(name, taken):
+    """Choose a file name for spider `name` that is not in `taken`.
+
+    The chosen file name is added to `taken`.
+    """
+    cleaned_name = _clean(name)
+    filename = 'spiders/{}.py'.format(cleaned_name)
+    suffix = 1
+    while filename in taken:
+        suffix += 1
+        filename = 'spiders/{}_{}.py'.format(cleaned_name, suffix)
+    taken.add(filename)
+    return filename
+
+
+def create_spider_file(name, spider, spec, schemas, extractors, items,
+                       selector='css', group_selectors=False, settings=None,
+                       canonicalize=False):
+    """Create the code of the module for a slybot spider."""
+    log.info('Creating spider "%s"' % spider.name)
+    referenced = set()
+    spider = create_spider(name, spider, spec, schemas, extractors, items,
+                           selector, group_selectors, settings, canonicalize,
+                           referenced)
     item_classes = ''
-    if items:
+    if referenced:
+        # Only import the item classes that the spider uses
         item_classes = '\nfrom ..items import {}'.format(
-            ', '.join((v().__class__.__name__ for v in items.values()))
-        )
-    spider_data = []
-    for name, (spider, spec) in spiders.items():
-        log.info('Creating spider "%s"' % spider.name)
-        spider = create_spider(name, spider, spec, schemas, extractors, items,
-                               selector)
-        cleaned_name = _clean(name)
-        filename = 'spiders/{}.py'.format(cleaned_name)
-        data = '\n'.join((SPIDER_FILE(item_classes=item_classes),
-                          spider.strip()))
-        code = fix_code(to_unicode(data), OPTIONS)
-        spider_data.append((filename, code))
-    return spider_data
-
-
-def port_project(dir_name, schemas, spiders, extractors, selector='css'):
-    """Create project layout, default files and project specific code."""
+            ', '.join(sorted(set(c.name for c in referenced))))
+    data = '\n'.join((SPIDER_FILE(item_classes=item_classes),
+                      spider.strip()))
+    return fix_code(to_unicode(data), OPTIONS)
+
+
+def spider_settings(dir_name, compact_dupefilter=False, crawl_order=None):
+    """Create the custom settings for the spiders of project `dir_name`."""
+    settings = dict(CRAWL_ORDER_SETTINGS.get(crawl_order, {}))
+    if compact_dupefilter:
+        settings['DUPEFILTER_CLASS'] = BLOOM_DUPEFILTER.format(dir_name)
+    return settings
+
+
+def port_project(dir_name, schemas, spiders, extractors, selector='css',
+                 item_class='scrapy', group_selectors=False,
+                 compact_dupefilter=False, crawl_order=None,
+                 split_items=False, compression=zipfile.ZIP_DEFLATED,
+                 compresslevel=None, reproducible=False, bytecode=False):
+    """Create project layout, default files and project specific code.
+
+    `spiders` may be an iterator from `load_project_data` with `lazy` set,
+    in which case each spider is written to the archive and released before
+    the next one is loaded.
+
+    With `compact_dupefilter` spiders filter duplicate requests with a
+    fixed size bloom filter and canonicalize the links they follow.
+    `crawl_order` configures spiders to crawl `breadth` or `depth` first.
+    With `split_items` each item class is written to its own module in an
+    `items` package.
+
+    The archive is compressed with `compression` and `compresslevel`. With
+    `reproducible` files are given a fixed timestamp so that the same
+    project always gives the same archive and with `bytecode` compiled
+    bytecode is included for every python module.
+    """
+    if bytecode and source_hash is None:
+        raise ValueError('Including bytecode requires python 3.7 or later')
     dir_name = class_name(dir_name)
+    settings = spider_settings(dir_name, compact_dupefilter, crawl_order)
     zbuff = BytesIO()
-    archive = UpdatingZipFile(zbuff, "w", zipfile.ZIP_DEFLATED)
+    archive = UpdatingZipFile(zbuff, "w", compression,
+                              compresslevel=compresslevel,
+                              date_time=FIXED_DATE_TIME if reproducible
+                              else None,
+                              bytecode=bytecode)
     write_to_archive(archive, '', start_scrapy_project(dir_name).items())
-    items_py, schema_names = create_schemas(schemas)
-    write_to_archive(archive, dir_name, [('items.py', items_py)])
+    if split_items:
+        item_files, schema_names = create_item_modules(schemas, item_class)
+        write_to_archive(archive, dir_name, item_files)
+    else:
+        items_py, schema_names = create_schemas(schemas, item_class)
+        write_to_archive(archive, dir_name, [('items.py', items_py)])
     write_to_archive(archive, dir_name, create_library_files())
 
-    # XXX: Hack to load items.py file
-    items_no_relative = items_py.replace(
-        'from .utils.processors import', 'from portia2code.processors import'
-    )
-    mod = imp.new_module('%s.%s' % (dir_name, 'items'))
-    exec(items_no_relative, mod.__dict__)
-    items = vars(mod)
-
-    # Load schema objects from module
-    schema_names = {}
-    for _id, name in schemas.items():
-        name = '{}Item'.format(class_name(name.get('name', _id)))
-        schema_names[_id] = items[name]
-    schema_names['_PortiaItem'] = items['PortiaItem']
-
-    spider_data = create_spiders(spiders, schemas, extractors, schema_names,
-                                 selector)
-    write_to_archive(archive, dir_name, spider_data)
+    item_classes = create_item_classes(schemas)
     archive.finalize()
+    spider_files = iter_spider_files(spiders, schemas, extractors,
+                                     item_classes, selector, group_selectors,
+                                     settings, compact_dupefilter)
+    for spider_file in spider_files:
+        write_to_archive(archive, dir_name, [spider_file])
+        archive.finalize()
     archive.close()
     zbuff.seek(0)
     return zbuff
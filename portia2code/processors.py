@@ -1,21 +1,19 @@
-import inspect
 import re
 import six
 
 from six.moves.urllib.parse import urljoin, urlparse, urlunparse
 
-from copy import deepcopy
-from itertools import chain
 try:
     from itertools import izip_longest
 except ImportError:
     from itertools import zip_longest as izip_longest
 
-from dateparser.date import DateDataParser
 from scrapy.loader.processors import Identity as _Identity
-from scrapy.utils.markup import unquote_markup
+try:
+    from itemloaders.common import wrap_loader_context
+except ImportError:
+    from scrapy.loader.common import wrap_loader_context
 from w3lib.html import remove_tags
-from .parser import SafeHtmlParser
 
 
 # Regeps from Scrapely_CSS_IMAGERE.pattern
@@ -30,6 +28,31 @@ _NUMBER_RE = re.compile(r'(-?\d+(?:\.\d+)?)')
 _DECIMAL_RE = re.compile(r'(\d[\d\,]*(?:(?:\.\d+)|(?:)))', re.U | re.M)
 _VALPARTS_RE = re.compile(r'([\.,]?\d+)')
 _SENTINEL = object()
+# Compiled patterns shared by every `Regex` processor
+_REGEX_REGISTRY = {}
+
+
+def _getargspec(func):
+    # Only needed to render processors so not imported with the module
+    import inspect
+    try:
+        return inspect.getfullargspec(func)
+    except AttributeError:
+        return inspect.getargspec(func)
+
+
+def _date_data_parser():
+    # dateparser is slow to import so it is only imported once dates are used
+    from dateparser.date import DateDataParser
+    return DateDataParser()
+
+
+def _unquote_markup(text):
+    try:
+        from w3lib.html import unquote_markup
+    except ImportError:
+        from scrapy.utils.markup import unquote_markup
+    return unquote_markup(text)
 
 
 def _strip_url(text):
@@ -70,7 +93,7 @@ class BaseProcessor(object):
         return '%s(%s)' % (self.__class__.__name__, str(self))
 
     def __str__(self):
-        argspec = inspect.getargspec(self.__init__)
+        argspec = _getargspec(self.__init__)
         args = argspec.args
         defaults = argspec.defaults or []
         joined = reversed(list(izip_longest(reversed(args), reversed(defaults),
@@ -99,7 +122,7 @@ class BaseProcessor(object):
 
 class Field(BaseProcessor):
     def __init__(self, name, selector, processors=None, required=False,
-                 type='css'):
+                 type='css', text=False, base=None, attribute=None):
         if processors is None:
             processors = []
         self.name = name
@@ -107,6 +130,37 @@ class Field(BaseProcessor):
         self.processors = processors
         self.required = required
         self.type = type
+        # Selector extracts text nodes rather than attributes
+        self.text = text
+        # Set when the field is extracted from nodes shared with other fields
+        self.base = base
+        self.attribute = attribute
+
+    def extract_from(self, nodes):
+        """Extract values from the nodes matched by the `base` selector.
+
+        Gives the same values as the field's own selector unless the base
+        selector matches nested nodes, whose text would then be repeated.
+        """
+        if self.attribute == '#content':
+            query = './/text()'
+        else:
+            query = '@{}'.format(self.attribute)
+        return [value for node in nodes
+                for value in node.xpath(query).extract()]
+
+    @property
+    def compiled_processors(self):
+        """Processors fused into a single `Pipeline`, built on first use."""
+        try:
+            return self._compiled_processors
+        except AttributeError:
+            pass
+        compiled = []
+        if self.processors:
+            compiled.append(Pipeline(self.processors, self.text))
+        self._compiled_processors = compiled
+        return compiled
 
 
 class Item(BaseProcessor):
@@ -122,122 +176,276 @@ class Identity(BaseProcessor, _Identity):
     pass
 
 
-class Text(BaseProcessor):
+def _clean_text(value):
+    if value and isinstance(value, six.string_types):
+        if isinstance(value, six.text_type):
+            return _clean_plain_text(value)
+        return remove_tags(value).strip()
+    return value
+
+
+def _clean_plain_text(text):
+    # Only run the tag stripping regex when there may be tags to strip
+    if u'<' in text:
+        return remove_tags(text).strip()
+    return text.strip()
+
+
+def _process_plain_text(text, loader_context=None):
+    return [_clean_plain_text(text)]
+
+
+def _numeric_entity(match):
+    return six.unichr(int(match.groups()[0]))
+
+
+class ValueProcessor(BaseProcessor):
+    """Processor that handles each value independently.
+
+    `_process` returns the results for a single value so that `Pipeline` can
+    fuse consecutive value processors into a single pass.
+    """
+    # Runs the `Text` processor on its input before `_process_text`
+    strips_input = False
+    # Produces values that the `Text` processor would leave unchanged
+    clean_output = False
+
     def __call__(self, values):
-        return [remove_tags(v).strip()
-                if v and isinstance(v, six.string_types) else v
-                for v in values]
+        return [result for value in values for result in self._process(value)]
+
+    def _process(self, value, loader_context=None):
+        return [value]
+
 
+class Text(ValueProcessor):
+    clean_output = True
 
-class Number(BaseProcessor):
     def __call__(self, values):
+        return [_clean_text(v) for v in values]
+
+    def _process(self, value, loader_context=None):
+        return [_clean_text(value)]
+
+
+class Number(ValueProcessor):
+    def _process(self, value, loader_context=None):
         numbers = []
-        for value in values:
-            if isinstance(value, (dict, list)):
-                numbers.append(value)
-            txt = _NUMERIC_ENTITIES.sub(lambda m: unichr(int(m.groups()[0])),
-                                        value)
-            numbers.append(_NUMBER_RE.findall(txt))
-        return list(chain(*numbers))
+        if isinstance(value, (dict, list)):
+            numbers.extend(value)
+        txt = _NUMERIC_ENTITIES.sub(_numeric_entity, value)
+        numbers.extend(_NUMBER_RE.findall(txt))
+        return numbers
 
 
-class Price(BaseProcessor):
-    def __call__(self, values):
+class Price(ValueProcessor):
+    def _process(self, value, loader_context=None):
         prices = []
-        for value in values:
-            if isinstance(value, (dict, list)):
-                prices.append(value)
-            txt = _NUMERIC_ENTITIES.sub(lambda m: unichr(int(m.groups()[0])),
-                                        value)
-            m = _DECIMAL_RE.search(txt)
-            if m:
-                value = m.group(1)
-                parts = _VALPARTS_RE.findall(value)
-                decimalpart = parts.pop(-1)
-                if decimalpart[0] == "," and len(decimalpart) <= 3:
-                    decimalpart = decimalpart.replace(",", ".")
-                value = "".join(parts + [decimalpart]).replace(",", "")
-                prices.append(value)
+        if isinstance(value, (dict, list)):
+            prices.append(value)
+        txt = _NUMERIC_ENTITIES.sub(_numeric_entity, value)
+        m = _DECIMAL_RE.search(txt)
+        if m:
+            value = m.group(1)
+            parts = _VALPARTS_RE.findall(value)
+            decimalpart = parts.pop(-1)
+            if decimalpart[0] == "," and len(decimalpart) <= 3:
+                decimalpart = decimalpart.replace(",", ".")
+            value = "".join(parts + [decimalpart]).replace(",", "")
+            prices.append(value)
         return prices
 
 
+class FirstNumber(BaseProcessor):
+    """Output processor keeping the first extracted number as a float."""
+    def __call__(self, values):
+        for value in values:
+            try:
+                return float(value)
+            except (TypeError, ValueError):
+                continue
+
+
 class Date(Text):
+    strips_input = True
+    clean_output = False
+
     def __init__(self, format='%Y-%m-%dT%H:%M:%S'):
         self.format = format
 
     def __call__(self, values):
-        values = super(Date, self).__call__(values)
+        return [date for value in values for date in self._process(value)]
+
+    def _process(self, value, loader_context=None):
+        return self._process_text(_clean_text(value), loader_context)
+
+    def _process_text(self, text, loader_context=None):
         dates = []
-        for text in values:
-            if isinstance(text, (dict, list)):
-                dates.append(text)
-            try:
-                date = DateDataParser().get_date_data(text)['date_obj']
-                dates.append(date.strftime(self.format))
-            except (ValueError, AttributeError):
-                pass
+        if isinstance(text, (dict, list)):
+            dates.append(text)
+        try:
+            date = _date_data_parser().get_date_data(text)['date_obj']
+            dates.append(date.strftime(self.format))
+        except (ValueError, AttributeError):
+            pass
         return dates
 
 
 class Url(Text):
+    strips_input = True
+    clean_output = False
+
     def __call__(self, values, loader_context=None):
-        values = super(Url, self).__call__(values)
+        return [url for value in values
+                for url in self._process(value, loader_context)]
+
+    def _process(self, value, loader_context=None):
+        return self._process_text(_clean_text(value), loader_context)
+
+    def _process_text(self, value, loader_context=None):
         urls = []
-        for value in values:
-            if isinstance(value, (dict, list)):
-                urls.append(value)
-            value = _strip_url(unquote_markup(value))
-            base = loader_context.get('baseurl', '')
-            urls.append(urljoin(base, value))
+        if isinstance(value, (dict, list)):
+            urls.append(value)
+        value = _strip_url(_unquote_markup(value))
+        base = loader_context.get('baseurl', '')
+        urls.append(urljoin(base, value))
         return urls
 
 
 class Image(Text):
     def __call__(self, values):
-        return super(Image, self).__call__([
-            val if isinstance(val, (dict, list)) else extract_image_url(val)
-            for val in values
-        ])
+        return [self._process(val)[0] for val in values]
+
+    def _process(self, value, loader_context=None):
+        if not isinstance(value, (dict, list)):
+            value = extract_image_url(value)
+        return [_clean_text(value)]
 
 
 class SafeHtml(Text):
+    clean_output = False
 
     def __init__(self, parser=None):
         if parser is None:
+            from .parser import SafeHtmlParser
             parser = SafeHtmlParser()
         self.parser = parser
 
     def __call__(self, values):
+        return [result for val in values for result in self._process(val)]
+
+    def _process(self, value, loader_context=None):
         results = []
-        for val in values:
-            if isinstance(val, (dict, list)):
-                results.append(val)
-            results.append(self.parser.feed(str(val)))
+        if isinstance(value, (dict, list)):
+            results.append(value)
+        results.append(self.parser.feed(str(value)))
         return results
 
 
-class Regex(BaseProcessor):
+def compile_regex(pattern):
+    """Compile `pattern` once and share the result between processors."""
+    try:
+        return _REGEX_REGISTRY[pattern]
+    except KeyError:
+        regexp = _REGEX_REGISTRY[pattern] = re.compile(pattern)
+        return regexp
+
+
+class Regex(ValueProcessor):
     def __init__(self, regexp):
         if isinstance(regexp, six.string_types):
-            regexp = re.compile(regexp)
+            regexp = compile_regex(regexp)
         self.regexp = regexp.pattern
         self._regexp = regexp
+        self._groups = regexp.groups
 
-    def __call__(self, values):
+    def _process(self, value, loader_context=None):
         results = []
-        for value in values:
-            if isinstance(value, (dict, list)):
-                results.append(value)
-            if not value:
-                continue
-            match = self._regexp.search(value)
-            if not match:
-                continue
-            results.append(
-                u"".join([g for g in match.groups() or match.group() if g])
-            )
+        if isinstance(value, (dict, list)):
+            results.append(value)
+        if not value:
+            return results
+        match = self._regexp.search(value)
+        if not match:
+            return results
+        if self._groups == 0:
+            results.append(match.group())
+        elif self._groups == 1:
+            results.append(match.group(1) or u"")
+        else:
+            results.append(u"".join([g for g in match.groups() if g]))
         return results
 
     def __deepcopy__(self, memo):
-        """Overwrite deepcopy so that the regexp is recalculated."""
-        return type(self)(deepcopy(self.regexp, memo))
+        """Overwrite deepcopy so that the compiled regexp is reused."""
+        return type(self)(self._regexp)
+
+
+def _fuse(steps):
+    def fused(values, loader_context=None):
+        results = []
+        for value in values:
+            pending = [value]
+            for step in steps:
+                pending = [result for pending_value in pending
+                           for result in step(pending_value, loader_context)]
+            results.extend(pending)
+        return results
+    return fused
+
+
+class Pipeline(object):
+    r"""Processor chain fused into as few passes over the values as possible.
+
+    Consecutive `ValueProcessor` instances are applied to each value in turn
+    instead of each building a new list, `Identity` processors are dropped and
+    text already cleaned by a previous processor is not cleaned again. Any
+    other processor is applied to the whole list of values as usual. The
+    results are the same as applying the processors one after another.
+
+    When `text` is set the values are known to be unicode text extracted by
+    a selector, so a leading `Text` processor skips its type checks.
+
+    >>> Pipeline([Text(), Text(), Regex(r'(\d+)')])([u'<b>Price: 42</b>'])
+    [u'42']
+    """
+    def __init__(self, processors, text=False):
+        self.processors = list(processors)
+        self._stages = list(self._compile(self.processors, text))
+
+    def __call__(self, values, loader_context=None):
+        for fused, stage in self._stages:
+            if values is None:
+                break
+            if fused:
+                values = stage(values, loader_context)
+            else:
+                values = wrap_loader_context(stage, loader_context)(values)
+        return values
+
+    def __repr__(self):
+        return '%s(%r)' % (self.__class__.__name__, self.processors)
+
+    @staticmethod
+    def _compile(processors, text=False):
+        steps, clean = [], False
+        for processor in processors:
+            if isinstance(processor, _Identity):
+                continue
+            if not isinstance(processor, ValueProcessor):
+                if steps:
+                    yield True, _fuse(steps)
+                    steps = []
+                clean = text = False
+                yield False, processor
+                continue
+            if clean and type(processor) is Text:
+                continue
+            if clean and processor.strips_input:
+                steps.append(processor._process_text)
+            elif text and type(processor) is Text:
+                steps.append(_process_plain_text)
+            else:
+                steps.append(processor._process)
+            clean, text = processor.clean_output, False
+        if steps:
+            yield True, _fuse(steps)
@@ -9,13 +9,14 @@ from .utils import extractor_to_field, container_to_item
 
 class ItemBuilder(object):
     def __init__(self, schemas, extractors, items, default_item,
-                 selector='css'):
+                 selector='css', group_selectors=False):
         self.schemas = schemas
         self.extractors = extractors
         self.items = items
         self.default_item = default_item
         self.numfields = 0
         self.selector = selector
+        self.group_selectors = group_selectors
 
     def extract(self, samples):
         data = []
@@ -57,9 +58,10 @@ class ItemBuilder(object):
         items = []
         for ext in extractor.extractors:
             items.extend(extractor_to_field(ext, schema, self.extractors,
-                                            self.selector))
+                                            self.selector,
+                                            self.group_selectors))
         return items
 
     def base_extractor(self, extractor, schema):
         return extractor_to_field(extractor, schema, self.extractors,
-                                  self.selector)
+                                  self.selector, self.group_selectors)
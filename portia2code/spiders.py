@@ -1,18 +1,205 @@
+import logging
+import struct
+import sys
+
+from hashlib import sha1
+from itertools import chain
+from timeit import default_timer
+
+from lxml import etree
+from scrapy import Request, signals
+from scrapy.http import TextResponse
 from scrapy.spiders import CrawlSpider
 from scrapy.loader import ItemLoader
+from scrapy.utils.misc import arg_to_iter
+from scrapy.utils.python import to_bytes
 from scrapy.utils.response import get_base_url
+try:
+    from itemloaders.common import wrap_loader_context
+except ImportError:
+    from scrapy.loader.common import wrap_loader_context
+try:
+    from itemadapter import ItemAdapter
+except ImportError:
+    ItemAdapter = None
+from twisted.internet.defer import Deferred
 
+from .links import compile_patterns
 from .starturls import FeedGenerator, FragmentGenerator
+logger = logging.getLogger(__name__)
 
 
 class RequiredFieldMissing(Exception):
-    def __init__(self, msg):
+    def __init__(self, msg, field=None):
         self.msg = msg
+        self.field = field
 
     def __str__(self):
         return self.msg
 
 
+class ExtractionStats(object):
+    """Record extraction metrics in the crawler stats collector.
+
+    Enabled in generated spiders with the `PORTIA_EXTRACTION_STATS` setting.
+    """
+    prefix = 'portia'
+    latency_buckets = ((0.001, '1ms'), (0.01, '10ms'), (0.1, '100ms'),
+                       (1.0, '1s'))
+
+    def __init__(self, stats):
+        self.stats = stats
+
+    def sample(self, index, elapsed, items):
+        key = '{}/samples/{}'.format(self.prefix, index)
+        self.stats.inc_value('{}/tried'.format(key))
+        if items:
+            self.stats.inc_value('{}/matched'.format(key))
+            self.stats.inc_value('{}/items'.format(key), len(items))
+        self.stats.inc_value('{}/time'.format(key), elapsed)
+        self.stats.inc_value('{}/latency/{}'.format(
+            key, self._latency_bucket(elapsed)))
+
+    def sample_skipped(self, index):
+        key = '{}/samples/{}'.format(self.prefix, index)
+        self.stats.inc_value('{}/skipped'.format(key))
+
+    def missing(self, exc):
+        self.stats.inc_value('{}/fields/missing'.format(self.prefix))
+        if exc.field is not None:
+            self.stats.inc_value('{}/fields/{}/missing'.format(
+                self.prefix, exc.field))
+
+    def timed(self, processor, name):
+        key = '{}/processors/{}/time'.format(self.prefix, name)
+        stats = self.stats
+
+        def timed_processor(values):
+            start = default_timer()
+            try:
+                return processor(values)
+            finally:
+                stats.inc_value(key, default_timer() - start)
+        return timed_processor
+
+    def request(self, item_page):
+        page_type = 'item_pages' if item_page else 'other_pages'
+        self.stats.inc_value('{}/requests/{}'.format(self.prefix, page_type))
+
+    def skipped(self, reason):
+        self.stats.inc_value('{}/pages/skipped/{}'.format(self.prefix, reason))
+
+    def page(self, items):
+        if items:
+            self.stats.inc_value('{}/pages/with_items'.format(self.prefix))
+        else:
+            self.stats.inc_value('{}/pages/without_items'.format(self.prefix))
+
+    def query(self, reused):
+        result = 'reused' if reused else 'run'
+        self.stats.inc_value('{}/queries/{}'.format(self.prefix, result))
+
+    def _latency_bucket(self, elapsed):
+        for limit, label in self.latency_buckets:
+            if elapsed <= limit:
+                return 'le_{}'.format(label)
+        return 'gt_{}'.format(self.latency_buckets[-1][1])
+
+
+class ExtractionPool(object):
+    """Extract items from responses in a pool of worker processes.
+
+    Enabled in generated spiders with the `PORTIA_EXTRACTION_WORKERS`
+    setting. Each worker creates its own instance of `spider_class` to
+    extract items with. At most `queue_size` responses per worker are
+    waiting for or being extracted at once and `extract` returns None
+    instead of queueing more.
+    """
+    def __init__(self, spider_class, workers, queue_size=2):
+        if sys.version_info < (3, 7):
+            raise ValueError('PORTIA_EXTRACTION_WORKERS requires python 3.7 '
+                             'or later')
+        import multiprocessing
+        from concurrent.futures import ProcessPoolExecutor
+        self.spider_class = spider_class
+        # Forking the crawler's process along with its threads isn't safe
+        self.executor = ProcessPoolExecutor(
+            workers, mp_context=multiprocessing.get_context('spawn'))
+        self.size = max(workers * queue_size, 1)
+        self.pending = 0
+
+    def extract(self, response):
+        """Return a deferred firing with the items of `response`.
+
+        None is returned when the queue is full.
+        """
+        if self.pending >= self.size:
+            return None
+        self.pending += 1
+        deferred = self._submit(response)
+        deferred.addBoth(self._done)
+        return deferred
+
+    def close(self):
+        self.executor.shutdown(wait=False)
+
+    def _done(self, result):
+        self.pending -= 1
+        return result
+
+    def _submit(self, response):
+        from twisted.internet import reactor
+        deferred = Deferred()
+        future = self.executor.submit(
+            _extract_items, self.spider_class, type(response), response.url,
+            response.body, response.encoding)
+        future.add_done_callback(
+            lambda f: reactor.callFromThread(_fire, deferred, f))
+        return deferred
+
+
+def _fire(deferred, future):
+    exc = future.exception()
+    if exc is not None:
+        deferred.errback(exc)
+    else:
+        deferred.callback(future.result())
+
+
+_worker_spiders = {}
+
+
+def _extract_items(spider_class, response_class, url, body, encoding):
+    # Run in worker processes, which keep a spider for each spider class
+    try:
+        spider = _worker_spiders[spider_class]
+    except KeyError:
+        spider = _worker_spiders[spider_class] = spider_class()
+    response = response_class(url, body=body, encoding=encoding)
+    return list(spider.parse_item(response))
+
+
+class SeenUrls(object):
+    """Set of URLs stored as 64 bit hashes instead of the URLs themselves.
+
+    Every URL added takes about 70 bytes however long it is, so a million
+    start URLs use about 70MB until the start requests have all been made.
+    """
+    def __init__(self):
+        self._hashes = set()
+
+    def __len__(self):
+        return len(self._hashes)
+
+    def add(self, url):
+        """Add `url`, returning False if it had already been seen."""
+        key = struct.unpack('<Q', sha1(to_bytes(url)).digest()[:8])[0]
+        if key in self._hashes:
+            return False
+        self._hashes.add(key)
+        return True
+
+
 class PortiaItemLoader(ItemLoader):
     def get_value(self, value, *processors, **kw):
         required = kw.pop('required', False)
@@ -24,58 +211,411 @@ class PortiaItemLoader(ItemLoader):
         return val
 
 
+class PortiaItemBuilder(object):
+    """Build items by applying field processors directly.
+
+    Produces the same items as `PortiaItemLoader` without the `ItemLoader`
+    machinery. A builder can be reused for every match of a definition on a
+    response by calling `reset` with the next item and selector.
+    """
+    default_input_processor = ItemLoader.default_input_processor
+    default_output_processor = ItemLoader.default_output_processor
+    _field_processors = {}
+    _undeclared_fields = set()
+
+    def __init__(self, item=None, selector=None, response=None, **context):
+        context['response'] = response
+        self.context = context
+        self._values = {}
+        self._wrapped = {}
+        self.reset(item, selector)
+
+    def reset(self, item, selector=None):
+        response = self.context['response']
+        if selector is None and response is not None:
+            # Query the whole response like ItemLoader
+            selector = response.selector
+        self.item = item
+        self.selector = selector
+        self.context['item'] = item
+        self.context['selector'] = selector
+        self._values.clear()
+        return self
+
+    def add_css(self, field_name, css, *processors, **kw):
+        values = self.selector.css(css).extract()
+        self.add_value(field_name, values, *processors, **kw)
+
+    def add_xpath(self, field_name, xpath, *processors, **kw):
+        values = self.selector.xpath(xpath).extract()
+        self.add_value(field_name, values, *processors, **kw)
+
+    def add_value(self, field_name, value, *processors, **kw):
+        value = self.get_value(value, *processors)
+        if kw.get('required') and not value:
+            raise RequiredFieldMissing(
+                'Missing required field "{value}" for "{item}"'.format(
+                    value=value, item=self.item.__class__.__name__),
+                field_name)
+        if value is None:
+            return
+        value = arg_to_iter(value)
+        processed = self._wrap(self._processors(field_name)[0])(value)
+        if processed:
+            self._values.setdefault(field_name, [])
+            self._values[field_name] += arg_to_iter(processed)
+
+    def get_value(self, value, *processors, **kw):
+        for processor in processors:
+            if value is None:
+                break
+            value = self._wrap(processor)(value)
+        return value
+
+    def load_item(self):
+        item = self.item
+        adapter = None if ItemAdapter is None else ItemAdapter(item)
+        for field_name, values in self._values.items():
+            value = self._wrap(self._processors(field_name)[1])(values)
+            if value is None:
+                continue
+            if adapter is None:
+                item[field_name] = value
+                continue
+            try:
+                adapter[field_name] = value
+            except KeyError:
+                self._undeclared_field(field_name)
+        return item
+
+    def _undeclared_field(self, field_name):
+        # Slotted attrs items only hold the fields their class declares
+        key = (self.item.__class__, field_name)
+        if key not in self._undeclared_fields:
+            self._undeclared_fields.add(key)
+            logger.warning('Dropping field "%s" not declared by "%s"',
+                           field_name, self.item.__class__.__name__)
+
+    def _processors(self, field_name):
+        key = (self.item.__class__, field_name)
+        try:
+            return self._field_processors[key]
+        except KeyError:
+            pass
+        if ItemAdapter is None:
+            meta = self.item.fields[field_name]
+        else:
+            try:
+                meta = ItemAdapter(self.item).get_field_meta(field_name)
+            except KeyError:
+                meta = {}
+        processors = (
+            meta.get('input_processor', self.default_input_processor),
+            meta.get('output_processor', self.default_output_processor)
+        )
+        self._field_processors[key] = processors
+        return processors
+
+    def _wrap(self, processor):
+        # Keyed by id as hashing processors renders their repr
+        try:
+            cached, wrapped = self._wrapped[id(processor)]
+            if cached is processor:
+                return wrapped
+        except KeyError:
+            pass
+        wrapped = wrap_loader_context(processor, self.context)
+        stats = self.context.get('stats')
+        if stats is not None:
+            name = getattr(processor, '__name__', type(processor).__name__)
+            wrapped = stats.timed(wrapped, name)
+        self._wrapped[id(processor)] = (processor, wrapped)
+        return wrapped
+
+
 class BasePortiaSpider(CrawlSpider):
-    loader = PortiaItemLoader
+    loader = PortiaItemBuilder
     items = []
+    # Requests for URLs shaped like sample URLs are scheduled first
+    item_url_patterns = []
+    item_page_priority = 10
+    # Xpath matching any page that a sample could extract items from
+    page_marker = None
+    # Xpath matching the top level containers of every sample and xpaths
+    # testing which container selector a matched node is for
+    container_query = None
+    container_tests = {}
+    # Pool of processes extracting items if `PORTIA_EXTRACTION_WORKERS` is set
+    extraction_pool = None
+
+    @classmethod
+    def from_crawler(cls, crawler, *args, **kwargs):
+        spider = super(BasePortiaSpider, cls).from_crawler(
+            crawler, *args, **kwargs)
+        settings = crawler.settings
+        workers = settings.getint('PORTIA_EXTRACTION_WORKERS')
+        if workers > 0:
+            spider.extraction_pool = ExtractionPool(
+                cls, workers,
+                settings.getint('PORTIA_EXTRACTION_QUEUE_SIZE', 2))
+            crawler.signals.connect(spider.extraction_pool.close,
+                                    signal=signals.spider_closed)
+        return spider
 
     def start_requests(self):
+        seen = SeenUrls()
         for url in self.start_urls:
             if isinstance(url, dict):
                 type_ = url['type']
                 if type_ == 'generated':
                     for generated_url in FragmentGenerator()(url):
-                        yield self.make_requests_from_url(generated_url)
+                        if seen.add(generated_url):
+                            yield self.make_requests_from_url(generated_url)
                 elif type_ == 'feed':
-                    yield FeedGenerator(self.parse)(url)
-            else:
+                    yield FeedGenerator(self.parse, seen)(url['url'])
+            elif seen.add(url):
                 yield self.make_requests_from_url(url)
 
+    @property
+    def extraction_stats(self):
+        """Stats recorder if `PORTIA_EXTRACTION_STATS` is enabled."""
+        try:
+            return self._extraction_stats
+        except AttributeError:
+            pass
+        crawler = getattr(self, 'crawler', None)
+        stats = None
+        if (crawler is not None and
+                crawler.settings.getbool('PORTIA_EXTRACTION_STATS')):
+            stats = ExtractionStats(crawler.stats)
+        self._extraction_stats = stats
+        return stats
+
+    def prioritise_request(self, request, response=None):
+        """Raise the priority of requests for likely item pages."""
+        matchers = self._item_url_matchers
+        item_page = any(m.search(request.url) for m in matchers)
+        stats = self.extraction_stats
+        if stats is not None:
+            stats.request(item_page)
+        if item_page:
+            return request.replace(
+                priority=request.priority + self.item_page_priority)
+        return request
+
+    @property
+    def _item_url_matchers(self):
+        try:
+            return self._item_url_regexes
+        except AttributeError:
+            pass
+        self._item_url_regexes = compile_patterns(self.item_url_patterns)
+        return self._item_url_regexes
+
+    def skip_response(self, response):
+        """Return why no sample can match `response`, if none can."""
+        if not isinstance(response, TextResponse):
+            return 'not_text'
+        if self.page_marker and not response.xpath(self.page_marker):
+            return 'no_marker'
+
+    def matched_containers(self, response):
+        """Find the top level container selectors matching `response`.
+
+        Containers are found with a single query and each node found is
+        tested against the selectors that haven't matched yet. Returns None
+        if the spider has no container query.
+        """
+        if not self.container_query:
+            return None
+        remaining = dict(self._container_matchers)
+        matched = set()
+        for node in response.xpath(self.container_query):
+            for selector, test in list(remaining.items()):
+                if test(node.root):
+                    matched.add(selector)
+                    del remaining[selector]
+            if not remaining:
+                break
+        return matched
+
+    @property
+    def _container_matchers(self):
+        try:
+            return self._container_xpaths
+        except AttributeError:
+            pass
+        self._container_xpaths = {
+            selector: etree.XPath(test)
+            for selector, test in self.container_tests.items()
+        }
+        return self._container_xpaths
+
+    # Overrides a private CrawlSpider method. Its signature and returning a
+    # deferred from a rule's callback were checked against Scrapy 2.4.1.
+    def _parse_response(self, response, callback, cb_kwargs, follow=True):
+        pool = self.extraction_pool
+        deferred = None
+        if (pool is not None and callback == self.parse_item and
+                not cb_kwargs and isinstance(response, TextResponse)):
+            deferred = pool.extract(response)
+        if deferred is None:
+            # Extracted here when the pool is full, which holds up
+            # downloads until the workers catch up
+            return super(BasePortiaSpider, self)._parse_response(
+                response, callback, cb_kwargs, follow)
+        # Links are followed while the items are extracted by a worker
+        requests = list(super(BasePortiaSpider, self)._parse_response(
+            response, None, cb_kwargs, follow))
+        deferred.addCallback(self._pooled_results, response, requests)
+        return deferred
+
+    def _pooled_results(self, items, response, requests):
+        stats = self.extraction_stats
+        if stats is not None:
+            stats.page(items)
+        items = self.process_results(response, items)
+        return list(chain(arg_to_iter(items), requests))
+
     def parse_item(self, response):
-        for sample in self.items:
+        stats = self.extraction_stats
+        reason = self.skip_response(response)
+        matched = None
+        if reason is None:
+            matched = self.matched_containers(response)
+            if matched is not None and not matched:
+                reason = 'no_marker'
+        if reason is not None:
+            if stats is not None:
+                stats.skipped(reason)
+            return
+        baseurl = get_base_url(response)
+        loaders = {}
+        # Samples often share selectors so results are reused between them
+        queries = {}
+        items = []
+        for index, sample in enumerate(self.items):
             items = []
+            if matched is not None and not any(
+                    definition.selector in matched for definition in sample):
+                # None of the sample's containers are on the page
+                if stats is not None:
+                    stats.sample_skipped(index)
+                continue
+            if stats is not None:
+                start = default_timer()
             try:
                 for definition in sample:
                     items.extend(
-                        [i for i in self.load_item(definition, response)]
+                        [i for i in self.load_item(definition, response,
+                                                   baseurl=baseurl,
+                                                   loaders=loaders,
+                                                   queries=queries)]
                     )
             except RequiredFieldMissing as exc:
                 self.logger.warning(str(exc))
+                if stats is not None:
+                    stats.missing(exc)
+            if stats is not None:
+                stats.sample(index, default_timer() - start, items)
             if items:
-                for item in items:
-                    yield item
                 break
+        if stats is not None:
+            stats.page(items)
+        for item in items:
+            yield item
 
-    def load_item(self, definition, response=None, selector=None):
+    def load_item(self, definition, response=None, selector=None,
+                  baseurl=None, loaders=None, queries=None):
+        """Extract items for `definition` from each node it matches.
+
+        Nested item definitions are queried only within the node matched by
+        their parent. When `loaders` is given, resettable loaders are shared
+        through it so each definition builds a single loader per response
+        however deeply it is nested. When `queries` is given, query results
+        are stored in it and reused for the same query on the same node.
+        """
         selector = response if selector is None else selector
-        query = selector.xpath if definition.type == 'xpath' else selector.css
-        selectors = query(definition.selector)
-        for selector in selectors:
+        if baseurl is None:
+            baseurl = get_base_url(response)
+        if loaders is None:
+            loaders = {}
+        # Shared base selectors are queried once per node
+        bases = {} if queries is None else queries
+        stats = self.extraction_stats
+        ld = loaders.get(id(definition))
+        matches = self.query(selector, definition.type, definition.selector,
+                             queries)
+        for selector in matches:
+            # Matches without content are treated as the whole response
             selector = selector if selector else None
-            ld = self.loader(
-                item=definition.item(),
-                selector=selector,
-                response=response,
-                baseurl=get_base_url(response)
-            )
+            node = response if selector is None else selector
+            if ld is not None and hasattr(ld, 'reset'):
+                ld.reset(definition.item(), selector)
+            else:
+                ld = self.loader(
+                    item=definition.item(),
+                    selector=selector,
+                    response=response,
+                    baseurl=baseurl,
+                    stats=stats
+                )
+                loaders[id(definition)] = ld
             for field in definition.fields:
                 if hasattr(field, 'fields'):
                     if field.name is not None:
                         ld.add_value(field.name,
-                                     self.load_item(field, response, selector))
+                                     self.load_item(field, response, selector,
+                                                    baseurl, loaders, queries))
+                    continue
+                # Unfused processors keep per processor timings in the stats
+                if stats is None:
+                    processors = field.compiled_processors
+                else:
+                    processors = field.processors
+                if getattr(field, 'base', None):
+                    matched = self.query(node, field.type, field.base, bases)
+                    ld.add_value(field.name, field.extract_from(matched),
+                                 *processors, required=field.required)
+                elif queries is not None:
+                    values = self.query(node, field.type, field.selector,
+                                        queries).extract()
+                    ld.add_value(field.name, values, *processors,
+                                 required=field.required)
                 elif field.type == 'xpath':
-                    ld.add_xpath(field.name, field.selector, *field.processors,
+                    ld.add_xpath(field.name, field.selector, *processors,
                                  required=field.required)
                 else:
-                    ld.add_css(field.name, field.selector, *field.processors,
+                    ld.add_css(field.name, field.selector, *processors,
                                required=field.required)
             yield ld.load_item()
+
+    def query(self, selector, type, query, queries=None):
+        """Run a css or xpath `query` on `selector`.
+
+        Results are stored in `queries` by node and reused when the same
+        query is run on the same node again.
+        """
+        node = getattr(getattr(selector, 'selector', selector), 'root', None)
+        if queries is None or not etree.iselement(node):
+            if type == 'xpath':
+                return selector.xpath(query)
+            return selector.css(query)
+        key = (node, type, query)
+        stats = self.extraction_stats
+        try:
+            result = queries[key]
+        except KeyError:
+            pass
+        else:
+            if stats is not None:
+                stats.query(True)
+            return result
+        if type == 'xpath':
+            result = selector.xpath(query)
+        else:
+            result = selector.css(query)
+        queries[key] = result
+        if stats is not None:
+            stats.query(False)
+        return result
@@ -1,15 +1,75 @@
-# Mock out starturls for ../spiders.py file
-class MockGenerator(object):
-    def __init__(self, *args, **kwargs):
-        pass
+"""Generate start URLs from the fragments and feeds of Portia spiders.
 
-    def __call__(self, *args, **kwargs):
-        return []
+Yields the same URLs in the same order as slybot's generators, but one
+at a time, so that spiders with large ranges or feeds don't hold every
+URL in memory.
+"""
+import re
 
+from datetime import datetime
 
-class FeedGenerator(MockGenerator):
-    pass
+from scrapy import Request
+from six.moves import range
 
+_FEED_URL_RE = re.compile(r'[^\r\n]+')
 
-class FragmentGenerator(MockGenerator):
-    pass
+
+class FragmentGenerator(object):
+    """Generate every combination of the values of a spec's fragments."""
+    def __call__(self, spec):
+        fragments = [self.fragment_values(f) for f in spec['fragments']]
+        return self._generate(fragments)
+
+    def fragment_values(self, fragment):
+        """Return a function returning an iterable of `fragment`'s values.
+
+        Ranges are generated again each time they are needed rather than
+        stored.
+        """
+        value = fragment['value']
+        type_ = fragment['type']
+        if type_ == 'range':
+            return lambda: self.process_range(value)
+        if type_ == 'list':
+            values = value.split(' ')
+        elif type_ == 'date':
+            values = [datetime.now().strftime(value)]
+        elif type_ == 'fixed':
+            values = [value]
+        else:
+            raise ValueError('Unknown fragment type "{}"'.format(type_))
+        return lambda: values
+
+    def process_range(self, fragment):
+        start, end = fragment.split('-')
+        if start.isalpha() and end.isalpha():
+            return (chr(i) for i in range(ord(start.lower()),
+                                          ord(end.lower()) + 1))
+        return (str(i) for i in range(int(start), int(end) + 1))
+
+    def _generate(self, fragments, prefix=''):
+        if not fragments:
+            yield prefix
+            return
+        for value in fragments[0]():
+            for url in self._generate(fragments[1:], prefix + value):
+                yield url
+
+
+class FeedGenerator(object):
+    """Request the URLs listed in a feed as they are found in its body.
+
+    URLs already added to `seen` are skipped.
+    """
+    def __init__(self, callback, seen=None):
+        self.callback = callback
+        self.seen = seen
+
+    def __call__(self, url):
+        return Request(url, callback=self.parse_urls)
+
+    def parse_urls(self, response):
+        for match in _FEED_URL_RE.finditer(response.text):
+            url = match.group()
+            if self.seen is None or self.seen.add(url):
+                yield Request(url, callback=self.callback)
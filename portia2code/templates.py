@@ -7,6 +7,7 @@ from scrapy.loader import ItemLoader
 from scrapy.loader.processors import Identity
 from scrapy.spiders import Rule
 
+from ..utils.links import PatternLinkExtractor
 from ..utils.spiders import BasePortiaSpider
 from ..utils.starturls import FeedGenerator, FragmentGenerator
 from ..utils.processors import Item, Field, Text, Number, Price, Date, Url, \
@@ -18,19 +19,21 @@ SPIDER_CLASS = """
 class {class_name}(BasePortiaSpider):
     name = "{name}"
     allowed_domains = {allowed_domains}
-    start_urls = {start_urls}
+    start_urls = {start_urls}{attributes}
     {rules}
     items = {items}
 """.format
 ITEMS_IMPORTS = """
 from __future__ import absolute_import
 
-import scrapy
+{attrs_import}import scrapy
 from collections import defaultdict
 from scrapy.loader.processors import Join, MapCompose, Identity
 from w3lib.html import remove_tags
-from .utils.processors import Text, Number, Price, Date, Url, Image
-
+from {package}utils.processors import Text, Number, Price, Date, Url, Image, \
+FirstNumber
+{portia_item}""".format
+PORTIA_ITEM = """
 
 class PortiaItem(scrapy.Item):
     fields = defaultdict(
@@ -55,6 +58,42 @@ class PortiaItem(scrapy.Item):
         return string
 
 """
+PORTIA_ITEM_IMPORT = """\
+from .portia_item import PortiaItem
+
+"""
+ITEMS_PACKAGE = """\
+\"\"\"Item classes, each imported from its own module when first used.\"\"\"
+from __future__ import absolute_import
+
+import sys
+from importlib import import_module
+from types import ModuleType
+
+ITEM_MODULES = {modules}
+__all__ = sorted(ITEM_MODULES)
+
+
+class LazyItems(ModuleType):
+    def __getattr__(self, name):
+        try:
+            module = ITEM_MODULES[name]
+        except KeyError:
+            raise AttributeError(name)
+        value = getattr(import_module('.' + module, self.__name__), name)
+        setattr(self, name, value)
+        return value
+
+    def __dir__(self):
+        return sorted(set(self.__dict__) | set(ITEM_MODULES))
+
+
+_items = LazyItems(__name__, __doc__)
+_items.__dict__.update(globals())
+# Keep the original module alive so that its globals are not cleared
+_items._module = sys.modules[__name__]
+sys.modules[__name__] = _items
+""".format
 ITEM_CLASS = """\
 class {name}Item(PortiaItem):
 {fields}
@@ -65,18 +104,38 @@ ITEM_FIELD = """\
         output_processor={output},
     )
 """.format
+ATTRS_ITEM_CLASS = """\
+@attr.s(slots=True)
+class {name}Item(object):
+{fields}
+""".format
+ATTRS_ITEM_FIELD = """\
+    {name} = attr.ib(
+        default=None,
+        type={type},
+        metadata={{
+            'input_processor': {input},
+            'output_processor': {output},
+        }},
+    )
+""".format
 RULES = """\
 rules = [
         Rule(
-            LinkExtractor(
+            {link_extractor}(
                 allow=({allow}),
-                deny=({deny})
+                deny=({deny}){link_options}
             ),
             callback='parse_item',
+            process_request='prioritise_request',
             follow=True
         )
     ]\
 """.format
+CLASS_ATTRIBUTE = """
+    {name} = {value}""".format
+LINK_OPTION = """,
+                {name}={value}""".format
 SETUP = """\
 from setuptools import setup, find_packages
 
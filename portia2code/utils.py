@@ -2,9 +2,13 @@ import ast
 import re
 
 from collections import defaultdict
-from cssselect import GenericTranslator
+from cssselect import (
+    ExpressionError, GenericTranslator, HTMLTranslator, SelectorError,
+    parse as parse_css
+)
 from inspect import getsource
 from itertools import chain, groupby
+from six.moves.urllib.parse import urlparse
 from slybot.plugins.scrapely_annotations.extraction import (
     RepeatedContainerExtractor
 )
@@ -13,33 +17,64 @@ from .processors import (
     Regex, Identity
 )
 _NTH_CHILD_RE = re.compile('(:nth-child\([+n]*(\d+)[+n]*\))')
+# Path segments that identify a single page rather than a site section
+_VARIABLE_SEGMENT_RE = re.compile(r'\d|[-_+,].*[-_+,]|^[^/]{30,}$')
+_URL_START = r'^https?://[^/]+'
+_ANY_PAGE_SELECTORS = frozenset({'', '*', 'html', 'body', ':root', 'head'})
 
 
 class XpathBridge(object):
     def __init__(self, *args, **kwargs):
-        self.attribute = kwargs.pop('attribute', None)
+        self._attribute = kwargs.pop('attribute', None)
+        self.group = kwargs.pop('group', False)
         self._selector = kwargs.get('selector')
         super(XpathBridge, self).__init__(*args, **kwargs)
 
     @property
     def selector(self):
-        if not self.attribute:
+        if not self._attribute:
             if self.type == 'xpath':
                 return css_to_xpath(self._selector)
             return self._selector
-        return build_selector(self._selector, self.attribute, self.type)
+        return build_selector(self._selector, self._attribute, self.type)
 
     @selector.setter
     def selector(self, value):
         if value:
             self._selector = value
 
+    @property
+    def attribute(self):
+        """Attribute extracted from the `base` nodes when grouping."""
+        if self.group:
+            return self._attribute
+
+    @attribute.setter
+    def attribute(self, value):
+        if value:
+            self._attribute = value
+
+    @property
+    def base(self):
+        """Selector shared by all fields extracted from the same nodes."""
+        if not self.group or not self._attribute:
+            return None
+        if self.type == 'xpath':
+            return ' | '.join(css_to_xpath(s.strip())
+                              for s in self._selector.split(','))
+        return self._selector
+
+    @base.setter
+    def base(self, value):
+        # Always derived from the selector and attribute
+        pass
+
 
 class Field(XpathBridge, _Field):
     def __init__(self, name, selector, processors=None, required=False,
-                 type='css', **kws):
+                 type='css', text=False, base=None, attribute=None, **kws):
         super(Field, self).__init__(name, selector, processors, required, type,
-                                    **kws)
+                                    text, base, attribute=attribute, **kws)
 
 
 class Item(XpathBridge, _Item):
@@ -47,6 +82,28 @@ class Item(XpathBridge, _Item):
         super(Item, self).__init__(item, name, selector, fields, type, **kws)
 
 
+class ItemClass(object):
+    """Symbolic reference to an item class defined in the generated items.
+
+    Rendered as the bare class name so it can be emitted in spider code
+    without having to import or execute the generated items module.
+    """
+    def __init__(self, name):
+        self.name = name
+
+    def __repr__(self):
+        return self.name
+
+    def __eq__(self, other):
+        return repr(self) == repr(other)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self.name)
+
+
 def _validate_identifier(name):
     try:
         mod = ast.parse('%s = 1' % name)
@@ -90,6 +147,11 @@ def class_name(name):
     return re.sub('(_[a-zA-Z])', lambda x: x.group()[-1].upper(), name)
 
 
+def module_name(name):
+    """Create module name from class name."""
+    return re.sub('(?<=[a-z0-9])([A-Z])', r'_\1', name).lower()
+
+
 def item_field_name(name):
     """Clean field names."""
     return _clean(name)
@@ -140,7 +202,128 @@ def build_selector(selector, attribute, selector_type):
     return query
 
 
-def extractor_to_field(extractor, schema, extractors, selector_type='css'):
+def referenced_item_classes(samples):
+    """Find the item classes used by items and nested items in samples."""
+    referenced = set()
+    items = [item for sample in samples for item in sample]
+    while items:
+        item = items.pop()
+        referenced.add(item.item)
+        items.extend(f for f in item.fields if hasattr(f, 'fields'))
+    return referenced
+
+
+def build_page_marker(samples):
+    """Build an xpath matching pages that at least one sample could match.
+
+    The xpath is a union of the top level container selectors of every
+    sample. None is returned when a container selector would match any page.
+    """
+    selectors = []
+    for sample in samples:
+        for item in sample:
+            for selector in item._selector.split(','):
+                selector = selector.strip()
+                if selector in _ANY_PAGE_SELECTORS:
+                    return None
+                selectors.append(selector)
+    if not selectors:
+        return None
+    try:
+        return ' | '.join(css_to_xpath(s) for s in sorted(set(selectors)))
+    except SelectorError:
+        return None
+
+
+class _SelfTestTranslator(HTMLTranslator):
+    """Translate css selectors into tests of whether a node matches them.
+
+    Selectors are read as HTML like `Selector.css` reads them, so element
+    names are matched case insensitively.
+
+    Combinators become conditions on the node's ancestors, parent or
+    preceding siblings instead of steps away from the context node.
+    """
+    def xpath_descendant_combinator(self, left, right):
+        return right.add_condition('ancestor::{}'.format(_node_test(left)))
+
+    def xpath_child_combinator(self, left, right):
+        return right.add_condition('parent::{}'.format(_node_test(left)))
+
+    def xpath_direct_adjacent_combinator(self, left, right):
+        return right.add_condition(
+            'preceding-sibling::*[1][self::{}]'.format(_node_test(left)))
+
+    def xpath_indirect_adjacent_combinator(self, left, right):
+        return right.add_condition(
+            'preceding-sibling::{}'.format(_node_test(left)))
+
+
+def _node_test(xpath):
+    # Only element tests with conditions can be moved onto another axis
+    if xpath.path not in ('', '*/'):
+        raise ExpressionError('Cannot test nodes against "{}"'.format(xpath))
+    if xpath.condition:
+        return '{}[{}]'.format(xpath.element, xpath.condition)
+    return xpath.element
+
+
+def _node_tests(selector):
+    translator = _SelfTestTranslator()
+    tests = []
+    for parsed in parse_css(selector):
+        if parsed.pseudo_element:
+            raise ExpressionError(
+                'Cannot test nodes against "{}"'.format(selector))
+        tests.append(_node_test(translator.xpath(parsed.parsed_tree)))
+    return tests
+
+
+def container_test(selector):
+    """Build an xpath testing if the context node matches css `selector`.
+
+    >>> container_test('table td, ul > li')
+    'self::td[ancestor::table] or self::li[parent::ul]'
+    """
+    return ' or '.join('self::{}'.format(t) for t in _node_tests(selector))
+
+
+def build_container_tests(samples):
+    """Map the top level container selectors of samples to node tests.
+
+    None is returned when a container selector would match any page or
+    can't be turned into a test.
+    """
+    tests = {}
+    for sample in samples:
+        for item in sample:
+            selectors = [s.strip() for s in item._selector.split(',')]
+            if any(s in _ANY_PAGE_SELECTORS for s in selectors):
+                return None
+            try:
+                tests[item.selector] = container_test(item._selector)
+            except SelectorError:
+                return None
+    return tests or None
+
+
+def build_container_query(samples):
+    """Build an xpath matching the top level containers of every sample.
+
+    Each container is found by its own path of a union, which lxml runs
+    about twice as fast as testing every node against every container.
+    Only samples accepted by `build_container_tests` are supported.
+    """
+    paths = set()
+    for sample in samples:
+        for item in sample:
+            paths.update('descendant-or-self::{}'.format(t)
+                         for t in _node_tests(item._selector))
+    return ' | '.join(sorted(paths))
+
+
+def extractor_to_field(extractor, schema, extractors, selector_type='css',
+                       group=False):
     anno = extractor.annotation
     selector = anno.metadata.get('selector')
     if not selector:
@@ -157,7 +340,9 @@ def extractor_to_field(extractor, schema, extractors, selector_type='css'):
                             build_processors(field, extractors),
                             bool(field.get('required')),
                             selector_type,
-                            attribute=attribute))
+                            attribute == '#content',
+                            attribute=attribute,
+                            group=group))
     return fields
 
 
@@ -187,7 +372,7 @@ def container_to_item(extractor, fields, schema, item, selector_type):
         if sel:
             field._selector = ', '.join(sel)
         new_fields.append(field)
-    return [Item(item(), get_field(extractor, schema), selector, new_fields,
+    return [Item(item, get_field(extractor, schema), selector, new_fields,
                  selector_type)]
 
 
@@ -213,7 +398,7 @@ def build_repeating_items(extractor, schema, item, selector, fields,
         item_fields.append(field)
     name = get_field(extractor, schema)
     selector = ', '.join(sel)
-    return [Item(item(), name, selector, item_fields, selector_type)]
+    return [Item(item, name, selector, item_fields, selector_type)]
 
 
 def generalise(selectors):
@@ -271,6 +456,61 @@ def generalise(selectors):
     return selectors_map
 
 
+def _path_segments(url):
+    return [s for s in urlparse(url).path.split('/') if s]
+
+
+def url_shape_pattern(url):
+    """Create a regex matching URLs with the same path shape as `url`.
+
+    >>> url_shape_pattern('http://example.com/product/blue-cotton-shirt')
+    '^https?://[^/]+/product/[^/?#]+/?(?:[?#]|$)'
+    """
+    parts = []
+    for segment in _path_segments(url):
+        if _VARIABLE_SEGMENT_RE.search(segment):
+            parts.append('[^/?#]+')
+        else:
+            parts.append(re.escape(segment))
+    path = ''.join('/' + part for part in parts)
+    return '{}{}/?(?:[?#]|$)'.format(_URL_START, path)
+
+
+def learn_link_patterns(template_urls, start_urls):
+    """Learn which links to follow from sample and start urls.
+
+    Links are followed if they are in a section of the site containing a
+    sample or start url. A sample url whose first path segment varies
+    between pages, such as a year or an id, can't name a section so links
+    with the same shape as it are followed instead. Sections are not
+    restricted if a start url is the site's home page. Links deeper than
+    one level below the deepest of these urls are not followed.
+
+    Returns the allow and deny patterns, which are empty when there are no
+    sample urls to learn from.
+    """
+    template_urls = [u for u in template_urls if u]
+    start_urls = [u for u in start_urls if u]
+    if not template_urls:
+        return [], []
+    urls = template_urls + start_urls
+    sections = [_path_segments(url)[:1] for url in urls]
+    if all(sections):
+        allow = set()
+        for url, section in zip(urls, sections):
+            if url in template_urls and \
+                    _VARIABLE_SEGMENT_RE.search(section[0]):
+                allow.add(url_shape_pattern(url))
+            else:
+                allow.add('{}/{}(?:[/?#]|$)'.format(
+                    _URL_START, re.escape(section[0])))
+    else:
+        allow = {'.*'}
+    depth = max(len(_path_segments(url)) for url in urls) + 1
+    deny = ['{}(?:/[^/?#]+){{{},}}'.format(_URL_START, depth + 1)]
+    return sorted(allow), deny
+
+
 def build_processors(field, extractors):
     processors = []
     # TODO: initialize with initial field type
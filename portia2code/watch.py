@@ -0,0 +1,283 @@
+"""Port spiders again as their Portia definitions are edited."""
+import logging
+import os
+import time
+import zipfile
+
+from collections import defaultdict
+from timeit import default_timer
+
+import six
+
+from slybot.utils import Storage
+
+from .porter import (
+    create_item_classes, create_item_modules, create_schemas,
+    create_spider_file, iter_spiders, port_project, spider_filename,
+    spider_settings
+)
+from .utils import class_name
+log = logging.getLogger(__name__)
+SCHEMA_KEYS = frozenset({'schema_id', 'scrapes'})
+
+
+def find_references(data, schemas=None, extractors=None):
+    """Find the schema and extractor ids used in a spider or sample."""
+    if schemas is None:
+        schemas, extractors = set(), set()
+    if isinstance(data, dict):
+        for key, value in data.items():
+            if key in SCHEMA_KEYS and isinstance(value, six.string_types):
+                schemas.add(value)
+            elif key == 'extractors' and isinstance(value, (list, dict)):
+                extractors.update(v for v in value
+                                  if isinstance(v, six.string_types))
+            else:
+                find_references(value, schemas, extractors)
+    elif isinstance(data, list):
+        for value in data:
+            find_references(value, schemas, extractors)
+    return schemas, extractors
+
+
+def changed_keys(old, new):
+    """Find the keys that were added, removed or changed between dicts."""
+    return {key for key in set(old) | set(new)
+            if old.get(key) != new.get(key)}
+
+
+class DependencyIndex(object):
+    """Index of the schemas and extractors used by each spider."""
+
+    def __init__(self):
+        self.schemas = defaultdict(set)
+        self.extractors = defaultdict(set)
+        self._references = {}
+
+    def update(self, name, storage):
+        """Index the spider definition and samples of spider `name`."""
+        self.remove(name)
+        schemas, extractors = set(), set()
+        for path in spider_paths(storage, name):
+            find_references(storage.open(path), schemas, extractors)
+        for schema_id in schemas:
+            self.schemas[schema_id].add(name)
+        for extractor_id in extractors:
+            self.extractors[extractor_id].add(name)
+        self._references[name] = (schemas, extractors)
+
+    def remove(self, name):
+        schemas, extractors = self._references.pop(name, ((), ()))
+        for schema_id in schemas:
+            self.schemas[schema_id].discard(name)
+        for extractor_id in extractors:
+            self.extractors[extractor_id].discard(name)
+
+    def using_schemas(self, schema_ids):
+        return set().union(*(self.schemas.get(s, ()) for s in schema_ids))
+
+    def using_extractors(self, extractor_ids):
+        return set().union(*(self.extractors.get(e, ())
+                             for e in extractor_ids))
+
+
+def spider_paths(storage, name):
+    """Find the json files defining spider `name` and its samples."""
+    paths = [storage.rel_path('spiders', '{}.json'.format(name))]
+    spider_dir = storage.rel_path('spiders', name)
+    if storage.isdir(spider_dir):
+        paths.extend(storage.rel_path(spider_dir, f)
+                     for f in sorted(storage.listdir(spider_dir))
+                     if f.endswith('.json'))
+    return paths
+
+
+def spider_for_path(path):
+    """Find the name of the spider a project file belongs to."""
+    parts = path.split(os.sep)
+    if len(parts) < 2 or parts[0] != 'spiders':
+        return None
+    if len(parts) == 2:
+        if parts[1].endswith('.json'):
+            return parts[1][:-len('.json')]
+        return None
+    return parts[1]
+
+
+class ProjectWatcher(object):
+    """Keep an unpacked ported project up to date with a Portia project.
+
+    Changed files are mapped to the spiders they affect and only those
+    spiders are ported again. Edits to a schema or extractor only affect
+    the spiders that use it.
+    """
+
+    def __init__(self, project_dir, out_dir, dir_name, interval=0.5,
+                 **options):
+        self.project_dir = project_dir
+        self.out_dir = out_dir
+        # port_project makes the package name from the name it is given
+        self.dir_name = dir_name
+        self.package_name = class_name(dir_name)
+        self.interval = interval
+        self.options = options
+        self.index = DependencyIndex()
+        self.files = {}
+        self.filenames = {}
+        self.item_files = set()
+
+    def port_all(self):
+        """Port the whole project to the output directory."""
+        storage = Storage(self.project_dir)
+        self.schemas = storage.open('items.json')
+        self.extractors = storage.open('extractors.json')
+        spiders = iter_spiders(storage, self.schemas, self.extractors)
+        project = port_project(self.dir_name, self.schemas, spiders,
+                               self.extractors, **self.options)
+        with zipfile.ZipFile(project) as archive:
+            archive.extractall(self.out_dir)
+            self.item_files = {n for n in archive.namelist()
+                               if n.startswith(self._path('items'))}
+        for name in self._spider_names(storage):
+            self.index.update(name, storage)
+        self.filenames = self._spider_filenames(storage)
+        self.files = self._snapshot()
+
+    def poll(self):
+        """Find the project files that changed since the last poll."""
+        files = self._snapshot()
+        changed = {path for path in set(files) | set(self.files)
+                   if files.get(path) != self.files.get(path)}
+        self.files = files
+        return changed
+
+    def update(self, changed):
+        """Port the spiders affected by the `changed` project files."""
+        storage = Storage(self.project_dir)
+        affected = set()
+        schemas, extractors = self.schemas, self.extractors
+        if 'items.json' in changed:
+            schemas = storage.open('items.json')
+            affected |= self.index.using_schemas(
+                changed_keys(self.schemas, schemas))
+        if 'extractors.json' in changed:
+            extractors = storage.open('extractors.json')
+            affected |= self.index.using_extractors(
+                changed_keys(self.extractors, extractors))
+        names = self._spider_names(storage)
+        for path in changed:
+            name = spider_for_path(path)
+            if name is None:
+                continue
+            if name in names:
+                self.index.update(name, storage)
+            else:
+                self.index.remove(name)
+            affected.add(name)
+        filenames = self._spider_filenames(storage)
+        # Spiders whose file name changed as other spiders were removed
+        affected.update(n for n, f in filenames.items()
+                        if self.filenames.get(n) != f)
+        if 'items.json' in changed:
+            self._write_items(schemas)
+        items = create_item_classes(schemas)
+        settings = spider_settings(self.package_name,
+                                   self.options.get('compact_dupefilter'),
+                                   self.options.get('crawl_order'))
+        spiders = iter_spiders(storage, schemas, extractors, affected & names)
+        for name, (spider, spec) in spiders:
+            code = create_spider_file(
+                name, spider, spec, schemas, extractors, items,
+                self.options.get('selector', 'css'),
+                self.options.get('group_selectors', False), settings,
+                self.options.get('compact_dupefilter', False))
+            self._write(filenames[name], code)
+        for name in affected:
+            filename = self.filenames.get(name)
+            if filename is not None and filename not in filenames.values():
+                self._remove(filename)
+        # Only kept once every change is ported so that failed changes are
+        # found again when they are retried
+        self.schemas, self.extractors = schemas, extractors
+        self.filenames = filenames
+        return affected
+
+    def run(self):
+        """Port the project and then port changes until interrupted."""
+        self.port_all()
+        log.info('Watching "%s" for changes', self.project_dir)
+        pending = set()
+        while True:
+            time.sleep(self.interval)
+            changed = self.poll()
+            if not changed:
+                continue
+            pending |= changed
+            start = default_timer()
+            try:
+                affected = self.update(pending)
+            except Exception:
+                # Keep the changes to port them with the next edit
+                log.exception('Failed to port changes')
+                continue
+            pending = set()
+            log.info('Updated %d spiders in %.3fs', len(affected),
+                     default_timer() - start)
+
+    def _spider_names(self, storage):
+        return {n[:-len('.json')] for n in storage.listdir('spiders')
+                if n.endswith('.json')}
+
+    def _spider_filenames(self, storage):
+        taken = set()
+        return {name: spider_filename(name, taken)
+                for name in sorted(self._spider_names(storage))}
+
+    def _snapshot(self):
+        files = {}
+        for base, _, filenames in os.walk(self.project_dir):
+            for filename in filenames:
+                path = os.path.join(base, filename)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                relpath = os.path.relpath(path, self.project_dir)
+                files[relpath] = (stat.st_mtime, stat.st_size)
+        return files
+
+    def _write_items(self, schemas):
+        item_class = self.options.get('item_class', 'scrapy')
+        if self.options.get('split_items'):
+            files, _ = create_item_modules(schemas, item_class)
+        else:
+            items_py, _ = create_schemas(schemas, item_class)
+            files = [('items.py', items_py)]
+        item_files = set()
+        for filename, code in files:
+            self._write(filename, code)
+            item_files.add(self._path(filename))
+        for path in self.item_files - item_files:
+            if path.endswith('.py'):
+                self._remove(path[len(self.package_name) + 1:])
+        self.item_files = item_files
+
+    def _path(self, filename):
+        return '{}/{}'.format(self.package_name, filename)
+
+    def _write(self, filename, code):
+        path = os.path.join(self.out_dir, self._path(filename))
+        code = code.encode('utf-8')
+        if os.path.exists(path):
+            with open(path, 'rb') as f:
+                if f.read() == code:
+                    return
+        log.info('Writing "%s"', path)
+        with open(path, 'wb') as f:
+            f.write(code)
+
+    def _remove(self, filename):
+        path = os.path.join(self.out_dir, self._path(filename))
+        if os.path.exists(path):
+            log.info('Removing "%s"', path)
+            os.remove(path)
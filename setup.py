@@ -13,6 +13,10 @@ install_requires = [
     'autoflake==0.6.6',
     'autopep8==1.2.2'
 ]
+tests_require = [
+    'attrs',
+    'pytest'
+]
 
 setup(
     name='portia2code',
@@ -25,8 +29,10 @@ setup(
     maintainer_email='ruairi@scrapinghub.com',
     packages=find_packages(exclude=('tests', 'tests.*')),
     platforms=['Any'],
-    scripts=['bin/portia_porter'],
+    scripts=['bin/portia_porter', 'bin/portia_compare'],
     install_requires=install_requires,
+    tests_require=tests_require,
+    extras_require={'tests': tests_require},
     url='https://github.com/scrapinghub/portia2code',
     download_url = 'https://github.com/scrapinghub/portia2code/tarball/portia2code-{}'.format(version),
     classifiers=[
@@ -0,0 +1,581 @@
+"""Benchmarks for ported spiders and their runtime library.
+
+Run from the repository root with::
+
+    python -m tests.bench [NAME ...]
+
+Every benchmark is run when no names are given. Each one compares the
+current code with the way the same work was done before it was optimised,
+or with the option that turns the optimisation off, on generated pages.
+"""
+from __future__ import print_function
+
+import copy
+import logging
+import re
+import subprocess
+import sys
+import tracemalloc
+
+from collections import OrderedDict
+from contextlib import contextmanager
+from timeit import default_timer, repeat
+
+import scrapy
+import six
+
+from scrapy import Request
+from scrapy.dupefilters import RFPDupeFilter
+from scrapy.http import HtmlResponse
+from scrapy.linkextractors import LinkExtractor
+from scrapy.utils.response import get_base_url
+from twisted.internet import defer, reactor, task
+from w3lib.html import remove_tags
+
+from portia2code import porter, processors, utils
+from portia2code.dupefilters import BloomDupeFilter
+from portia2code.links import PatternLinkExtractor
+from portia2code.processors import Field, Item, Price, Regex, Text
+from portia2code.spiders import (
+    BasePortiaSpider, ExtractionPool, PortiaItemLoader, RequiredFieldMissing
+)
+from portia2code.utils import build_container_query, build_container_tests
+
+BENCHMARKS = OrderedDict()
+# Benchmarks that need to run the twisted reactor, which can only run once
+REACTOR_BENCHMARKS = {'workers'}
+
+
+def benchmark(function):
+    BENCHMARKS[function.__name__] = function
+    return function
+
+
+def best_time(function, number=1):
+    """Fastest time in seconds of calling `function` in 5 runs."""
+    return min(repeat(function, number=number, repeat=5)) / number
+
+
+def show(label, seconds, baseline=None):
+    line = '  {:<44} {:9.3f}ms'.format(label, seconds * 1000)
+    if baseline is not None:
+        line += '  {:5.2f}x'.format(baseline / seconds)
+    print(line)
+
+
+class BenchItem(scrapy.Item):
+    title = scrapy.Field()
+    price = scrapy.Field()
+    crumbs = scrapy.Field()
+    dates = scrapy.Field()
+    variants = scrapy.Field()
+    options = scrapy.Field()
+    name = scrapy.Field()
+
+
+def sample(required=None):
+    fields = [Field('title', 'h1 *::text', [Text()]),
+              Field('price', '.price *::text', [Price()]),
+              Field('crumbs', 'ul.crumbs li *::text', [Text()]),
+              Field('dates', 'div span *::text', [Text()])]
+    if required is not None:
+        fields.append(Field('title', required, [], required=True))
+    return [Item(BenchItem, None, '#main', fields)]
+
+
+class BenchSpider(BasePortiaSpider):
+    name = 'bench'
+    # Samples missing a required field are tried before the one that matches
+    items = [sample('.missing-%d *::text' % i) for i in range(5)] + [sample()]
+
+
+class BaselineMixin(object):
+    """Extraction as it was done before loaders and queries were reused."""
+    loader = PortiaItemLoader
+
+    def parse_item(self, response):
+        for sample in self.items:
+            items = []
+            try:
+                for definition in sample:
+                    items.extend(
+                        [i for i in self.load_item(definition, response)]
+                    )
+            except RequiredFieldMissing as exc:
+                self.logger.warning(str(exc))
+            if items:
+                for item in items:
+                    yield item
+                break
+
+    def load_item(self, definition, response=None, selector=None):
+        selector = response if selector is None else selector
+        query = selector.xpath if definition.type == 'xpath' else selector.css
+        selectors = query(definition.selector)
+        for selector in selectors:
+            selector = selector if selector else None
+            ld = self.loader(
+                item=definition.item(),
+                selector=selector,
+                response=response,
+                baseurl=get_base_url(response)
+            )
+            for field in definition.fields:
+                if hasattr(field, 'fields'):
+                    if field.name is not None:
+                        ld.add_value(field.name,
+                                     self.load_item(field, response, selector))
+                elif field.type == 'xpath':
+                    ld.add_xpath(field.name, field.selector, *field.processors,
+                                 required=field.required)
+                else:
+                    ld.add_css(field.name, field.selector, *field.processors,
+                               required=field.required)
+            yield ld.load_item()
+
+
+# Samples missing required fields log a warning for every page
+logging.getLogger(BenchSpider.name).setLevel(logging.ERROR)
+
+
+def page(number, rows=200):
+    crumbs = u''.join(u'<li>c%d</li>' % i for i in range(30))
+    rows = u''.join(u'<div class="r%d"><p>row %d</p><span>2021-01-%02d</span>'
+                    u'</div>' % (i, i, i % 28 + 1) for i in range(rows))
+    body = (u'<html><body><ul class="crumbs">%s</ul><div id="main">'
+            u'<h1>Product <b>%d</b></h1><p class="price">$1,%03d.50</p>%s'
+            u'</div></body></html>') % (crumbs, number, number, rows)
+    return HtmlResponse('http://example.com/product/%d' % number,
+                        body=body, encoding='utf-8')
+
+
+def extraction_time(spider, responses):
+    """Seconds taken to extract the items of every response."""
+    return best_time(lambda: [list(spider.parse_item(r)) for r in responses])
+
+
+class NoReuseSpider(BenchSpider):
+    """Runs every query of every sample again."""
+    def query(self, selector, type, query, queries=None):
+        return super(NoReuseSpider, self).query(selector, type, query)
+
+
+@benchmark
+def queries():
+    """Samples sharing queries, five of them missing a required field."""
+    print('Spider with 6 samples, time per page:')
+    responses = [page(i) for i in range(20)]
+    baseline = extraction_time(NoReuseSpider(), responses) / 20
+    show('queries run for every sample', baseline)
+    show('queries reused between samples',
+         extraction_time(BenchSpider(), responses) / 20, baseline)
+
+
+class NestedSpider(BasePortiaSpider):
+    name = 'nested'
+    items = [[
+        Item(BenchItem, None, 'body', [
+            Field('title', 'h1::text', [Text()]),
+            Item(BenchItem, 'variants', '.product', [
+                Field('title', 'h2::text', [Text()]),
+                Field('price', '.price::text', [Price()]),
+                Item(BenchItem, 'options', '.variant', [
+                    Field('name', 'h3::text', [Text()]),
+                    Item(BenchItem, 'options', '.option', [
+                        Field('name', '::text', [Text()])])])])])
+    ]]
+
+
+class BaselineNestedSpider(BaselineMixin, NestedSpider):
+    pass
+
+
+def nested_page(products=20, variants=5, options=4):
+    option = u''.join(u'<i class="option">o%d</i>' % i
+                      for i in range(options))
+    variant = u''.join(u'<div class="variant"><h3>v%d</h3>%s</div>' % (
+        i, option) for i in range(variants))
+    body = u''.join(
+        u'<div class="product"><h2>p%d</h2><p class="price">%d.99</p>%s'
+        u'</div>' % (i, i, variant) for i in range(products))
+    return HtmlResponse('http://example.com/list', encoding='utf-8',
+                        body=u'<html><body><h1>List</h1>%s</body></html>' %
+                        body)
+
+
+@benchmark
+def nested():
+    """Nested items with four levels of definitions."""
+    print('Nested items, time per page:')
+    for products in (5, 20, 80):
+        responses = [nested_page(products)]
+        baseline = extraction_time(BaselineNestedSpider(), responses)
+        show('{} products, a loader per match'.format(products), baseline)
+        show('{} products, reused loaders'.format(products),
+             extraction_time(NestedSpider(), responses), baseline)
+
+
+class BaselineRegex(processors.BaseProcessor):
+    """`Regex` as it was before patterns were shared."""
+    def __init__(self, regexp):
+        if isinstance(regexp, six.string_types):
+            regexp = re.compile(regexp)
+        self.regexp = regexp.pattern
+        self._regexp = regexp
+
+    def __call__(self, values):
+        results = []
+        for value in values:
+            if isinstance(value, (dict, list)):
+                results.append(value)
+            if not value:
+                continue
+            match = self._regexp.search(value)
+            if not match:
+                continue
+            results.append(
+                u"".join([g for g in match.groups() or match.group() if g])
+            )
+        return results
+
+    def __deepcopy__(self, memo):
+        return type(self)(copy.deepcopy(self.regexp, memo))
+
+
+@benchmark
+def regex():
+    """Regex processors of a project with many extractors."""
+    # More distinct patterns than the re module caches
+    patterns = [r'(\d+)\s*x{}'.format(i) for i in range(600)]
+    values = [u'Size: %d x%d cm' % (i, i % 600) for i in range(2000)]
+
+    def construct(cls):
+        processors._REGEX_REGISTRY.clear()
+        # Every spider module creates the processors of its extractors
+        return lambda: [cls(p) for _ in range(3) for p in patterns]
+
+    print('Regex processors:')
+    baseline = best_time(construct(BaselineRegex))
+    show('create 1800, recompiled', baseline)
+    show('create 1800, shared patterns', best_time(construct(Regex)),
+         baseline)
+    for groups, pattern in ((0, r'\d+ cm'), (1, r'(\d+) cm'),
+                            (2, r'(\d+) x(\d+)')):
+        old, new = BaselineRegex(pattern), Regex(pattern)
+        baseline = best_time(lambda: old(values), 10)
+        show('apply to 2000 values, {} groups, joined'.format(groups),
+             baseline)
+        show('apply to 2000 values, {} groups'.format(groups),
+             best_time(lambda: new(values), 10), baseline)
+    old, new = BaselineRegex(patterns[-1]), Regex(patterns[-1])
+    baseline = best_time(lambda: copy.deepcopy(old), 1000)
+    show('deepcopy, recompiled', baseline)
+    show('deepcopy, reusing the pattern',
+         best_time(lambda: copy.deepcopy(new), 1000), baseline)
+
+
+class BaselineText(processors.BaseProcessor):
+    """`Text` as it was before plain text skipped tag stripping."""
+    def __call__(self, values):
+        return [remove_tags(v).strip() if isinstance(v, six.string_types)
+                else v for v in values]
+
+
+TextItem = type('TextItem', (scrapy.Item,),
+                {'cell%d' % i: scrapy.Field() for i in range(8)})
+
+
+class TextSpider(BasePortiaSpider):
+    name = 'text'
+
+    def __init__(self, processor, text):
+        super(TextSpider, self).__init__()
+        self.items = [[Item(TextItem, None, 'tr', [
+            Field('cell%d' % i, 'td:nth-child(%d)::text' % (i + 1),
+                  [processor()], text=text) for i in range(8)])]]
+
+
+def text_page(rows=300):
+    cells = u''.join(u'<td> cell %d of a row with plain text </td>' % i
+                     for i in range(8))
+    return HtmlResponse('http://example.com/table', encoding='utf-8',
+                        body=u'<html><body><table>%s</table></body></html>'
+                        % (u'<tr>%s</tr>' % cells * rows))
+
+
+@benchmark
+def text():
+    """Text processors on pages of plain text."""
+    print('Text processors:')
+    values = [u' plain text value %d ' % i for i in range(10000)]
+    baseline = best_time(lambda: BaselineText()(values), 10)
+    show('10000 values, tags always stripped', baseline)
+    show('10000 values', best_time(lambda: Text()(values), 10), baseline)
+    responses = [text_page()]
+    baseline = extraction_time(TextSpider(BaselineText, False),
+                               responses)
+    show('300 items of 8 fields, tags always stripped', baseline)
+    show('300 items of 8 text fields',
+         extraction_time(TextSpider(Text, True), responses), baseline)
+
+
+def filter_memory(dupefilter, count):
+    """Bytes allocated by `dupefilter` after filtering `count` requests."""
+    tracemalloc.start()
+    try:
+        start = tracemalloc.get_traced_memory()[0]
+        dupefilter = dupefilter()
+        for i in range(count):
+            dupefilter.request_seen(
+                Request('http://example.com/product/%d?page=1' % i))
+        return tracemalloc.get_traced_memory()[0] - start
+    finally:
+        tracemalloc.stop()
+
+
+@benchmark
+def dupefilter():
+    """Memory used by duplicate request filters as crawls grow."""
+    print('Duplicate request filters, memory after filtering:')
+    for count in (10000, 50000, 200000):
+        baseline = filter_memory(RFPDupeFilter, count)
+        line = '  {:<44} {:9.1f}MB'
+        print(line.format('{} requests, fingerprints'.format(count),
+                          baseline / 1e6))
+        print(line.format('{} requests, bloom filter'.format(count),
+                          filter_memory(BloomDupeFilter, count) / 1e6))
+    requests = [Request('http://example.com/product/%d' % i)
+                for i in range(10000)]
+    # Scrapy caches fingerprints, so only the filters themselves are timed
+
+    def filter_requests(dupefilter):
+        def run():
+            seen = dupefilter().request_seen
+            return [seen(r) for r in requests]
+        return run
+
+    baseline = best_time(filter_requests(RFPDupeFilter))
+    show('filter 10000 requests, fingerprints', baseline)
+    show('filter 10000 requests, bloom filter',
+         best_time(filter_requests(BloomDupeFilter)), baseline)
+
+
+@benchmark
+def links():
+    """Links followed by pattern with many follow and exclude patterns."""
+    allow = [r'/category-{}/\d+'.format(i) for i in range(200)]
+    deny = [r'/category-{}/\d+/reviews'.format(i) for i in range(0, 200, 4)]
+    urls = ['http://example.com/category-%d/%d%s' % (
+        i % 250, i, '/reviews' if i % 3 else '') for i in range(5000)]
+    anchors = u''.join(u'<a href="%s">link %d</a>' % (url, i)
+                       for i, url in enumerate(urls[:2000]))
+    response = HtmlResponse('http://example.com/', encoding='utf-8',
+                            body=u'<html><body>%s</body></html>' % anchors)
+    old = LinkExtractor(allow=allow, deny=deny)
+    new = PatternLinkExtractor(allow=allow, deny=deny)
+    print('Link extractors, {} follow and {} exclude patterns:'.format(
+        len(allow), len(deny)))
+    baseline = best_time(lambda: [old.matches(u) for u in urls])
+    show('match 5000 urls, a regex per pattern', baseline)
+    show('match 5000 urls, combined patterns',
+         best_time(lambda: [new.matches(u) for u in urls]), baseline)
+    baseline = best_time(lambda: old.extract_links(response))
+    show('page of 2000 links, a regex per pattern', baseline)
+    show('page of 2000 links, combined patterns',
+         best_time(lambda: new.extract_links(response)), baseline)
+
+
+LAYOUTS = ['.layout-{}'.format(i) for i in range(12)]
+# The porter's own definitions of the samples' containers
+LAYOUT_SAMPLES = [[utils.Item(BenchItem, None, layout, [])]
+                  for layout in LAYOUTS]
+
+
+class ContainerSpider(BasePortiaSpider):
+    name = 'containers'
+    # A sample for each layout of the site's pages
+    items = [[Item(BenchItem, None, layout, [
+        Field('title', 'h1 *::text', [Text()]),
+        Field('price', '.price *::text', [Price()]),
+        Field('dates', 'div span *::text', [Text()])])] for layout in LAYOUTS]
+
+
+class TestedContainerSpider(ContainerSpider):
+    container_tests = build_container_tests(LAYOUT_SAMPLES)
+    container_query = build_container_query(LAYOUT_SAMPLES)
+
+
+def layout_page(layout, rows=200):
+    rows = u''.join(u'<div><p>row %d</p><span>2021-01-%02d</span></div>' % (
+        i, i % 28 + 1) for i in range(rows))
+    body = (u'<html><body><div class="layout-%s"><h1>Product</h1>'
+            u'<p class="price">$10.50</p>%s</div></body></html>') % (
+                layout, rows)
+    return HtmlResponse('http://example.com/%s' % layout, body=body,
+                        encoding='utf-8')
+
+
+@benchmark
+def containers():
+    """Spiders with many samples on pages matching few or none of them."""
+    print('Spider with 12 samples, time per page:')
+    for label, layout in (('first', 0), ('last', 11), ('no', 'other')):
+        responses = [layout_page(layout)]
+        baseline = extraction_time(ContainerSpider(), responses)
+        show('{} sample matching, every sample tried'.format(label),
+             baseline)
+        show('{} sample matching, containers found first'.format(label),
+             extraction_time(TestedContainerSpider(), responses), baseline)
+
+
+class BenchSpiderLoader(object):
+    """Loads spiders whose specs are as large as ones with many samples."""
+    def __init__(self, storage):
+        self.spider_names = {'spider%d' % i for i in range(storage.spiders)}
+
+    def load_spider(self, name):
+        return {'name': name, 'templates': [{'original_body': u'x' * 200000}]}
+
+
+class BenchStorage(object):
+    def __init__(self, spiders):
+        self.spiders = spiders
+
+    def open(self, *args, **kwargs):
+        return {}
+
+
+@contextmanager
+def patched(module, **attributes):
+    original = {name: getattr(module, name) for name in attributes}
+    for name, value in attributes.items():
+        setattr(module, name, value)
+    try:
+        yield
+    finally:
+        for name, value in original.items():
+            setattr(module, name, value)
+
+
+def porting_peak(spiders, lazy):
+    """Peak bytes allocated while porting `spiders` spiders."""
+    tracemalloc.start()
+    try:
+        _, _, spiders = porter.load_project_data(BenchStorage(spiders), lazy)
+        porter.port_project('bench', {}, spiders, {})
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+@benchmark
+def spiders():
+    """Peak memory of porting projects with more and more spiders."""
+    print('Porting projects, peak memory:')
+    # Only loading spiders is measured, not porting their samples
+    with patched(porter, SpiderLoader=BenchSpiderLoader,
+                 IblSpider=lambda name, spec, *args: spec,
+                 create_spider_file=lambda name, *args: u'# %s\n' % name):
+        for count in (10, 50, 200):
+            line = '  {:<44} {:9.1f}MB'
+            print(line.format('{} spiders, loaded at once'.format(count),
+                              porting_peak(count, False) / 1e6))
+            print(line.format('{} spiders, loaded one at a time'.format(
+                count), porting_peak(count, True) / 1e6))
+
+
+# Modules that processors.py imported when it was loaded before they were
+# deferred to where they are used
+EAGER_IMPORTS = ('import inspect; from dateparser.date import DateDataParser; '
+                 'from portia2code.parser import SafeHtmlParser; ')
+
+
+def import_time(statement):
+    """Seconds taken by a new python process to run `statement`."""
+    command = [sys.executable, '-W', 'ignore', '-c', statement]
+    return best_time(lambda: subprocess.check_call(command))
+
+
+@benchmark
+def imports():
+    """Time taken to start a spider process and import processors.py."""
+    print('Importing processors in a new process:')
+    startup = import_time('import scrapy')
+    show('scrapy alone', startup)
+    baseline = import_time(EAGER_IMPORTS + 'import portia2code.processors')
+    show('processors, importing everything', baseline)
+    show('processors', import_time('import portia2code.processors'),
+         baseline)
+    show('processors, parsing a date', import_time(
+        'from portia2code.processors import Date; Date()([u"2021-01-05"])'),
+        baseline)
+
+
+@defer.inlineCallbacks
+def measure_workers(responses, workers):
+    spider = BenchSpider()
+    spider._follow_links = False
+    if workers:
+        spider.extraction_pool = ExtractionPool(BenchSpider, workers)
+        # Start the workers before timing
+        yield defer.gatherResults([
+            spider.extraction_pool.extract(r) for r in responses[:workers]])
+    start = default_timer()
+    results, pooled = [], 0
+    for response in responses:
+        result = spider._parse_response(response, spider.parse_item, {},
+                                        False)
+        if isinstance(result, defer.Deferred):
+            pooled += 1
+            results.append(result)
+        else:
+            results.append(defer.succeed(list(result)))
+        # Let finished extractions free their slots as downloads would
+        yield task.deferLater(reactor, 0, lambda: None)
+    items = yield defer.gatherResults(results)
+    elapsed = default_timer() - start
+    if spider.extraction_pool is not None:
+        spider.extraction_pool.close()
+    print('  {:>2} workers: {:7.1f} pages/s, {} items, {} pages to workers'
+          .format(workers, len(responses) / elapsed,
+                  sum(len(i) for i in items), pooled))
+
+
+@benchmark
+@defer.inlineCallbacks
+def workers():
+    """Pages extracted per second with PORTIA_EXTRACTION_WORKERS.
+
+    Throughput only grows with the number of workers up to the number of
+    cores.
+    """
+    print('Extraction workers:')
+    responses = [page(i) for i in range(200)]
+    for count in (0, 1, 2, 4):
+        yield measure_workers(responses, count)
+
+
+def main(names):
+    names = names or list(BENCHMARKS)
+    for name in names:
+        if name not in BENCHMARKS:
+            sys.exit('Unknown benchmark "{}", choose from: {}'.format(
+                name, ', '.join(BENCHMARKS)))
+    for name in names:
+        if name not in REACTOR_BENCHMARKS:
+            BENCHMARKS[name]()
+    deferreds = [BENCHMARKS[n] for n in names if n in REACTOR_BENCHMARKS]
+    if deferreds:
+        @defer.inlineCallbacks
+        def run():
+            try:
+                for function in deferreds:
+                    yield function()
+            finally:
+                reactor.stop()
+        reactor.callWhenRunning(run)
+        reactor.run()
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
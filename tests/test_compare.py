@@ -0,0 +1,152 @@
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+from collections import Counter
+
+from portia2code import compare, porter
+from portia2code.processors import Field, Item
+from portia2code.templates import SPIDER_CLASS
+from portia2code.utils import ItemClass, class_name, referenced_item_classes
+
+PAGE = b"""<html><body>
+<div class="product"><h1>Shoe</h1><span class="price">10</span></div>
+<div class="product"><h1>Hat</h1></div>
+</body></html>"""
+SAMPLES = [[Item(ItemClass('ProductItem'), None, '.product', [
+    Field('title', 'h1::text', []),
+    Field('price', '.price::text', [])])]]
+
+
+class FakeIblSpider(object):
+    """Slybot spider extracting the items given to it."""
+    def __init__(self, name, items):
+        self.name = name
+        self.items = items
+
+
+def fake_slybot_items(spider, response):
+    return spider.items
+
+
+def fake_spider(name, spider, spec, schemas, extractors, items, selector,
+                group_selectors, settings, canonicalize, referenced):
+    referenced.update(referenced_item_classes(SAMPLES))
+    return SPIDER_CLASS(class_name=class_name(name), name=name,
+                        allowed_domains=[], start_urls=[], attributes='',
+                        rules='rules = []', items=repr(SAMPLES))
+
+
+class CompareItemsTest(unittest.TestCase):
+    def test_fields_are_counted(self):
+        results = {}
+        compare.compare_items(
+            [{'title': u'Shoe', 'price': u'10'}, {'title': u'Hat'}],
+            [{'title': u'Shoe', 'price': u'12'},
+             {'title': u'Hat', 'colour': u'red'}, {'title': u'Bag'}],
+            results)
+        self.assertEqual(results, {
+            'title': Counter(same=2, extra=1),
+            'price': Counter(different=1),
+            'colour': Counter(extra=1)})
+
+    def test_missing_items(self):
+        results = {'title': Counter(same=1)}
+        compare.compare_items([{'title': u'Shoe'}, {'title': u'Hat'}], [],
+                              results)
+        self.assertEqual(results, {'title': Counter(same=1, missing=2)})
+
+    def test_item_fields(self):
+        self.assertEqual(
+            compare.item_fields({'title': [u' Shoe ', u'red'], 'price': 10,
+                                 'size': None, '_template': u'1234'}),
+            {'title': u'Shoe red', 'price': u'10', 'size': None})
+
+
+class ProductSpider(object):
+    name = 'products'
+
+    def parse_item(self, response):
+        for node in response.css('.product'):
+            yield {'title': node.css('h1::text').extract_first(),
+                   'price': node.css('.price::text').extract_first()}
+
+
+class CompareSpiderTest(unittest.TestCase):
+    def setUp(self):
+        self.addCleanup(setattr, compare, 'slybot_items',
+                        compare.slybot_items)
+        compare.slybot_items = fake_slybot_items
+
+    def test_both_versions_are_compared(self):
+        spider = FakeIblSpider('products', [{'title': [u'Shoe'],
+                                             'price': [u'10']}])
+        response = compare.HtmlResponse('http://example.com/', body=PAGE)
+        results = compare.compare_spider(spider, ProductSpider,
+                                         [response, response])
+        self.assertEqual(results['pages'], 2)
+        self.assertEqual(results['slybot_items'], 2)
+        self.assertEqual(results['ported_items'], 4)
+        self.assertEqual(results['fields'], {
+            'title': Counter(same=2, extra=2),
+            'price': Counter(same=2, extra=2)})
+
+
+class FormatReportTest(unittest.TestCase):
+    def test_report(self):
+        report = compare.OrderedDict([('products', {
+            'pages': 4, 'slybot_time': 2.0, 'ported_time': 0.5,
+            'slybot_items': 8, 'ported_items': 7,
+            'fields': {'title': Counter(same=7, missing=1),
+                       'price': Counter(different=2)}})])
+        self.assertEqual(compare.format_report(report).splitlines(), [
+            'Spider "products": 4 pages',
+            '  slybot       8 items     2.0000s        2.0 pages/s',
+            '  ported       7 items     0.5000s        8.0 pages/s',
+            '  speedup 4.00x',
+            '  price                   same=0 different=2 missing=0 extra=0',
+            '  title                   same=7 different=0 missing=1 extra=0',
+        ])
+
+    def test_no_time(self):
+        report = {'products': {
+            'pages': 0, 'slybot_time': 0.0, 'ported_time': 0.0,
+            'slybot_items': 0, 'ported_items': 0, 'fields': {}}}
+        lines = compare.format_report(report).splitlines()
+        self.assertEqual(len(lines), 3)
+        self.assertIn('0.0 pages/s', lines[1])
+
+
+class CompareProjectTest(unittest.TestCase):
+    def setUp(self):
+        for module, name, fake in [
+                (compare, 'slybot_items', fake_slybot_items),
+                (compare, 'load_project_data', self.load_project_data),
+                (porter, 'create_spider', fake_spider)]:
+            self.addCleanup(setattr, module, name, getattr(module, name))
+            setattr(module, name, fake)
+        self.corpus = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.corpus)
+        with open(os.path.join(self.corpus, 'shoes.html'), 'wb') as f:
+            f.write(PAGE)
+
+    def load_project_data(self, storage):
+        items = [{'title': u'Shoe', 'price': u'10'}, {'title': u'Hat'}]
+        spiders = {name: (FakeIblSpider(name, items), {})
+                   for name in storage}
+        return {'product': {'name': 'product', 'fields': {}}}, {}, spiders
+
+    def test_projects_are_compared_in_turn(self):
+        first = compare.compare_project(['books'], self.corpus)
+        second = compare.compare_project(['hats', 'toys'], self.corpus)
+        self.assertEqual(list(first), ['books'])
+        self.assertEqual(list(second), ['hats', 'toys'])
+        for results in (first['books'], second['hats'], second['toys']):
+            self.assertEqual(results['ported_items'], 2)
+            self.assertEqual(results['fields'], {
+                'title': Counter(same=2), 'price': Counter(same=1)})
+        package = class_name(compare.PROJECT_NAME)
+        self.assertFalse([name for name in sys.modules
+                          if name.split('.')[0] == package])
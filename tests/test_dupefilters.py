@@ -0,0 +1,65 @@
+import hashlib
+import shutil
+import tempfile
+import unittest
+
+from scrapy import Request
+
+from portia2code.dupefilters import BloomDupeFilter, BloomFilter
+
+
+def keys(start, stop):
+    return [hashlib.sha1(str(i).encode('ascii')).hexdigest()
+            for i in range(start, stop)]
+
+
+class BloomFilterTest(unittest.TestCase):
+    def test_added_keys_are_always_found(self):
+        bloom = BloomFilter(1000, 0.01)
+        added = keys(0, 1000)
+        for key in added:
+            bloom.add(key)
+        self.assertTrue(all(key in bloom for key in added))
+        self.assertTrue(all(bloom.add(key) for key in added))
+
+    def test_false_positive_rate_is_bounded(self):
+        bloom = BloomFilter(1000, 0.01)
+        for key in keys(0, 1000):
+            bloom.add(key)
+        false_positives = sum(key in bloom for key in keys(1000, 21000))
+        # Allow for chance well beyond the expected 200
+        self.assertLess(false_positives, 400)
+
+    def test_add_reports_new_keys(self):
+        bloom = BloomFilter(1000, 0.0001)
+        self.assertFalse(bloom.add(keys(0, 1)[0]))
+        self.assertTrue(bloom.add(keys(0, 1)[0]))
+
+    def test_bits_of_another_size_are_ignored(self):
+        bloom = BloomFilter(1000, 0.01, bytearray(b'\xff' * 3))
+        self.assertNotIn(keys(0, 1)[0], bloom)
+
+
+class BloomDupeFilterTest(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.path)
+
+    def test_requests_seen(self):
+        dupefilter = BloomDupeFilter(capacity=1000, error_rate=0.001)
+        request = Request('http://example.com/item/1')
+        self.assertFalse(dupefilter.request_seen(request))
+        self.assertTrue(dupefilter.request_seen(request.replace()))
+        self.assertFalse(dupefilter.request_seen(
+            Request('http://example.com/item/2')))
+
+    def test_filter_is_kept_in_job_dir(self):
+        requests = [Request('http://example.com/item/%d' % i)
+                    for i in range(100)]
+        dupefilter = BloomDupeFilter(self.path, capacity=1000,
+                                     error_rate=0.001)
+        for request in requests:
+            dupefilter.request_seen(request)
+        dupefilter.close('finished')
+        resumed = BloomDupeFilter(self.path, capacity=1000, error_rate=0.001)
+        self.assertTrue(all(resumed.request_seen(r) for r in requests))
@@ -0,0 +1,61 @@
+import re
+import unittest
+
+from scrapy.http import HtmlResponse
+from scrapy.linkextractors import LinkExtractor
+
+from portia2code.links import PatternLinkExtractor, compile_patterns
+
+PATTERNS = [r'/item/\d+', r'/product/', r'^https?://shop\.', r'\.html$',
+            r'/(a|b)/\1/', r'/(?P<section>[a-z]+)/(?P=section)',
+            r'(?i)/Sale/', re.compile(r'/CAPS/', re.I), r'[?&]page=\d']
+URLS = [
+    'http://example.com/item/12', 'http://example.com/item/x',
+    'http://example.com/product/1', 'https://shop.example.com/',
+    'http://example.com/a.html', 'http://example.com/a/a/',
+    'http://example.com/a/b/', 'http://example.com/news/news',
+    'http://example.com/news/sport', 'http://example.com/sale/',
+    'http://example.com/caps/', 'http://example.com/list?page=2',
+    'http://example.com/about',
+]
+
+
+def matches(regexes, url):
+    return any(r.search(url) for r in regexes)
+
+
+class CompilePatternsTest(unittest.TestCase):
+    def test_matches_patterns_compiled_separately(self):
+        separate = [re.compile(p) for p in PATTERNS]
+        combined = compile_patterns(PATTERNS)
+        for url in URLS:
+            self.assertEqual(matches(combined, url), matches(separate, url),
+                             url)
+
+    def test_uncombinable_patterns_are_kept_separate(self):
+        combined = compile_patterns(PATTERNS)
+        self.assertEqual(len(combined), 5)
+        self.assertEqual(
+            combined[0].pattern,
+            r'(?:/item/\d+)|(?:/product/)|(?:^https?://shop\.)|(?:\.html$)'
+            r'|(?:[?&]page=\d)')
+        self.assertEqual([r.pattern for r in combined[1:]], [
+            r'/(a|b)/\1/', r'/(?P<section>[a-z]+)/(?P=section)',
+            r'(?i)/Sale/', r'/CAPS/'])
+        self.assertTrue(combined[4].flags & re.I)
+
+    def test_no_patterns(self):
+        self.assertEqual(compile_patterns([]), [])
+
+
+class PatternLinkExtractorTest(unittest.TestCase):
+    def test_extracts_the_same_links(self):
+        body = u''.join(u'<a href="%s">link</a>' % url for url in URLS)
+        response = HtmlResponse('http://example.com/', body=body,
+                                encoding='utf-8')
+        for allow, deny in [(PATTERNS, ()), (PATTERNS[:4], PATTERNS[4:]),
+                            ((), PATTERNS)]:
+            expected = LinkExtractor(allow=allow, deny=deny)
+            extractor = PatternLinkExtractor(allow=allow, deny=deny)
+            self.assertEqual(extractor.extract_links(response),
+                             expected.extract_links(response))
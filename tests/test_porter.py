@@ -0,0 +1,286 @@
+import shutil
+import sys
+import tempfile
+import unittest
+import zipfile
+
+from ast import literal_eval
+from six import BytesIO
+
+from portia2code import porter
+from portia2code.processors import Field, Item
+from portia2code.templates import SPIDER_CLASS
+from portia2code.utils import ItemClass, referenced_item_classes
+
+
+class FakeSpiderLoader(object):
+    """Spider loader appending the spiders it loads to its storage."""
+    names = ['books', 'music', 'toys']
+
+    def __init__(self, storage):
+        self.loaded = storage
+
+    @property
+    def spider_names(self):
+        return set(self.names)
+
+    def load_spider(self, name):
+        self.loaded.append(name)
+        return {'name': name}
+
+
+class FakeIblSpider(object):
+    def __init__(self, name, spec, schemas, extractors, settings):
+        self.name = name
+
+
+def fake_spider_file(name, spider, spec, *args):
+    return u'# {}\n'.format(name)
+
+
+class ClosingStorage(list):
+    """Storage of the names of loaded spiders recording when it is closed."""
+    closed = False
+
+    def open(self, *args, **kwargs):
+        return {}
+
+    def close(self):
+        self.closed = True
+
+
+class StreamSpidersTest(unittest.TestCase):
+    def setUp(self):
+        for name, fake in [('SpiderLoader', FakeSpiderLoader),
+                           ('IblSpider', FakeIblSpider),
+                           ('create_spider_file', fake_spider_file)]:
+            self.addCleanup(setattr, porter, name, getattr(porter, name))
+            setattr(porter, name, fake)
+        self.loaded = []
+
+    def test_spiders_are_loaded_when_requested(self):
+        spiders = porter.iter_spiders(self.loaded, {}, {})
+        name, (spider, spec) = next(spiders)
+        self.assertEqual((name, spider.name, spec), ('books', 'books',
+                                                     {'name': 'books'}))
+        self.assertEqual(self.loaded, ['books'])
+        self.assertEqual([n for n, _ in spiders], ['music', 'toys'])
+        self.assertEqual(self.loaded, ['books', 'music', 'toys'])
+
+    def test_spider_files_are_created_when_requested(self):
+        files = porter.iter_spider_files(
+            porter.iter_spiders(self.loaded, {}, {}), {}, {}, {})
+        self.assertEqual(next(files), ('spiders/books.py', u'# books\n'))
+        self.assertEqual(self.loaded, ['books'])
+
+    def test_storage_is_closed_once_spiders_are_loaded(self):
+        storage = ClosingStorage()
+        _, _, spiders = porter.load_project_data(storage, lazy=True)
+        next(spiders)
+        self.assertFalse(storage.closed)
+        list(spiders)
+        self.assertTrue(storage.closed)
+        storage = ClosingStorage()
+        _, _, spiders = porter.load_project_data(storage)
+        self.assertEqual(sorted(spiders), ['books', 'music', 'toys'])
+        self.assertTrue(storage.closed)
+
+    def test_only_named_spiders_are_loaded(self):
+        spiders = porter.iter_spiders(self.loaded, {}, {}, ['toys', 'cars'])
+        self.assertEqual([n for n, _ in spiders], ['toys'])
+        self.assertEqual(self.loaded, ['toys'])
+
+
+PROJECT_FILES = {
+    'project.json': '{"name": "shop"}',
+    'items.json': '{"product": {"fields": {}}}',
+    'extractors.json': '{}',
+    'spiders/books.json': '{"name": "books"}',
+    'spiders/books/1234.json': '{"id": "1234"}',
+    'spiders/toys.json': '{"name": "toys"}',
+}
+
+
+def project_zip(prefix=''):
+    buff = BytesIO()
+    with zipfile.ZipFile(buff, 'w') as archive:
+        if prefix:
+            archive.writestr('README', 'Exported project')
+        for name, contents in PROJECT_FILES.items():
+            archive.writestr(prefix + name, contents)
+    buff.seek(0)
+    return buff
+
+
+class ZipStorageTest(unittest.TestCase):
+    def test_project_at_top_level(self):
+        with porter.ZipStorage(project_zip()) as storage:
+            self.assertEqual(storage.base_path, '')
+            self.assertProjectIsRead(storage)
+
+    def test_project_in_directory(self):
+        with porter.ZipStorage(project_zip('exports/shop/')) as storage:
+            self.assertEqual(storage.base_path, 'exports/shop')
+            self.assertProjectIsRead(storage)
+            self.assertFalse(storage.isdir('README'))
+
+    def assertProjectIsRead(self, storage):
+        self.assertTrue(storage.isdir('spiders'))
+        self.assertTrue(storage.isdir('spiders/'))
+        self.assertTrue(storage.isdir('spiders', 'books'))
+        self.assertFalse(storage.isdir('items.json'))
+        self.assertFalse(storage.isdir('templates'))
+        self.assertEqual(storage.listdir('spiders'),
+                         ['books', 'books.json', 'toys.json'])
+        self.assertEqual(storage.listdir('spiders', 'books'), ['1234.json'])
+        with self.assertRaises(OSError):
+            storage.listdir('templates')
+        self.assertEqual(storage.open('items.json'),
+                         {'product': {'fields': {}}})
+        self.assertEqual(storage.open('spiders', 'books', '1234.json'),
+                         {'id': '1234'})
+        self.assertEqual(storage.open('project.json', raw=True),
+                         u'{"name": "shop"}')
+
+    def test_close(self):
+        storage = porter.ZipStorage(project_zip())
+        storage.close()
+        self.assertIsNone(storage.archive.fp)
+
+
+class UpdatingZipFileTest(unittest.TestCase):
+    def test_files_are_listed_in_order_across_batches(self):
+        buff = BytesIO()
+        archive = porter.UpdatingZipFile(buff, 'w')
+        batches = [['utils/spiders.py', 'items.py'], ['spiders/toys.py'],
+                   ['spiders/books.py', 'settings.py']]
+        for batch in batches:
+            for name in batch:
+                archive.writestr(zipfile.ZipInfo(name), name)
+            archive.finalize()
+        archive.writestr(zipfile.ZipInfo('__init__.py'), '')
+        archive.close()
+        with zipfile.ZipFile(buff) as archive:
+            self.assertIsNone(archive.testzip())
+            names = archive.namelist()
+            self.assertEqual(names, sorted(names))
+            self.assertEqual(archive.read('spiders/books.py'),
+                             b'spiders/books.py')
+            self.assertIn('__init__.py', names)
+
+
+    def test_bytecode_requires_python_37(self):
+        self.addCleanup(setattr, porter, 'source_hash', porter.source_hash)
+        porter.source_hash = None
+        with self.assertRaises(ValueError):
+            porter.port_project('shop', {}, {}, {}, bytecode=True)
+
+
+class CrawlOrderTest(unittest.TestCase):
+    def setUp(self):
+        self.settings = []
+
+        def spider_file(name, spider, spec, schemas, extractors, items,
+                        selector, group_selectors, settings, canonicalize):
+            self.settings.append(settings)
+            return fake_spider_file(name, spider, spec)
+        self.addCleanup(setattr, porter, 'create_spider_file',
+                        porter.create_spider_file)
+        porter.create_spider_file = spider_file
+
+    def port(self, **kwargs):
+        spiders = {'books': (FakeIblSpider('books', {}, {}, {}, {}), {}),
+                   'toys': (FakeIblSpider('toys', {}, {}, {}, {}), {})}
+        return porter.port_project('shop', {}, spiders, {}, **kwargs)
+
+    def test_crawl_order_settings_are_given_to_spiders(self):
+        for order in ('breadth', 'depth'):
+            del self.settings[:]
+            self.port(crawl_order=order)
+            self.assertEqual(self.settings,
+                             [porter.CRAWL_ORDER_SETTINGS[order]] * 2)
+
+    def test_default_crawl_order(self):
+        self.port()
+        self.assertEqual(self.settings, [{}, {}])
+
+    def test_settings_are_combined(self):
+        settings = porter.spider_settings('shop', True, 'depth')
+        self.assertEqual(settings, {
+            'DEPTH_PRIORITY': -1,
+            'DUPEFILTER_CLASS': 'shop.utils.dupefilters.BloomDupeFilter'})
+        self.assertEqual(literal_eval(porter.format_settings(settings)),
+                         settings)
+
+
+SCHEMAS = {name: {'name': name, 'fields': {}}
+           for name in ('author', 'book', 'toy')}
+BOOKS_SAMPLES = [[Item(ItemClass('BookItem'), None, '.book', [
+    Field('title', 'h1::text', []),
+    Item(ItemClass('AuthorItem'), 'author', '.author', [
+        Field('name', '::text', [])])])]]
+
+
+def fake_spider(name, spider, spec, schemas, extractors, items, selector,
+                group_selectors, settings, canonicalize, referenced):
+    referenced.update(referenced_item_classes(BOOKS_SAMPLES))
+    return SPIDER_CLASS(class_name='Books', name=name, allowed_domains=[],
+                        start_urls=[], attributes='', rules='rules = []',
+                        items=repr(BOOKS_SAMPLES))
+
+
+class ItemsPackageTest(unittest.TestCase):
+    """Import the items package of a project ported with `split_items`."""
+    def setUp(self):
+        self.addCleanup(setattr, porter, 'create_spider',
+                        porter.create_spider)
+        porter.create_spider = fake_spider
+        project = porter.port_project(
+            'shop', SCHEMAS, {'books': (FakeIblSpider('books', {}, {}, {},
+                                                      {}), {})},
+            {}, split_items=True)
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path)
+        with zipfile.ZipFile(project) as archive:
+            archive.extractall(path)
+        sys.path.insert(0, path)
+        self.addCleanup(sys.path.remove, path)
+        self.addCleanup(self.unload)
+
+    def unload(self):
+        for name in list(sys.modules):
+            if name == 'Shop' or name.startswith('Shop.'):
+                del sys.modules[name]
+
+    def imported(self):
+        return {name[len('Shop.items.'):] for name in sys.modules
+                if name.startswith('Shop.items.')}
+
+    def test_classes_are_imported_when_used(self):
+        from Shop import items
+        self.assertEqual(self.imported(), set())
+        self.assertEqual(items.BookItem.__name__, 'BookItem')
+        self.assertEqual(self.imported(), {'book_item', 'portia_item'})
+        with self.assertRaises(AttributeError):
+            items.MissingItem
+
+    def test_spider_imports_referenced_classes(self):
+        from Shop.spiders import books
+        self.assertEqual(self.imported(),
+                         {'author_item', 'book_item', 'portia_item'})
+        item = books.Books.items[0][0]
+        self.assertEqual(item.item.__name__, 'BookItem')
+        self.assertEqual(item.fields[1].item.__name__, 'AuthorItem')
+
+    def test_star_import(self):
+        namespace = {}
+        exec('from Shop.items import *', namespace)
+        self.assertEqual(
+            sorted(n for n in namespace if n != '__builtins__'),
+            ['AuthorItem', 'BookItem', 'PortiaItem', 'ToyItem'])
+
+    def test_dir(self):
+        from Shop import items
+        self.assertTrue({'AuthorItem', 'BookItem', 'PortiaItem',
+                         'ToyItem'}.issubset(dir(items)))
+        self.assertEqual(self.imported(), set())
@@ -0,0 +1,166 @@
+import copy
+import itertools
+import re
+import subprocess
+import sys
+import unittest
+
+try:
+    from itemloaders.common import wrap_loader_context
+except ImportError:
+    from scrapy.loader.common import wrap_loader_context
+from w3lib.html import remove_tags
+
+from portia2code.processors import (
+    Date, Field, Identity, Image, Number, Pipeline, Price, Regex, SafeHtml,
+    Text, Url, compile_regex
+)
+
+VALUES = [
+    u'<b>Price: 1,234.50</b>',
+    u' 12 May 2020 ',
+    u'<a href="/images/shoe.jpg">Shoe</a>',
+    u'plain 42 and 7',
+    u'background-image: url(/static/a.png)',
+    u'  ',
+    u'',
+]
+CONTEXT = {'baseurl': 'http://example.com/shop/'}
+
+
+PROCESSORS = [
+    Text, Number, Price, Url, Image, SafeHtml,
+    lambda: Regex(r'(\d+)'), lambda: Regex(r'\w+'),
+    lambda: Regex(r'(\d+)\D+(\d+)'), Identity,
+]
+
+
+def chains(length):
+    """Processor factories for every chain of `length` processors."""
+    return itertools.product(PROCESSORS, repeat=length)
+
+
+def apply_in_turn(chain, values):
+    for processor in chain:
+        if values is None:
+            break
+        values = wrap_loader_context(processor, CONTEXT)(values)
+    return values
+
+
+def outcome(pipeline, values):
+    """Values returned by `pipeline` or the type of exception raised."""
+    try:
+        return pipeline(list(values), CONTEXT)
+    except Exception as exc:
+        return type(exc)
+
+
+class PipelineTest(unittest.TestCase):
+    def assertSameResults(self, factories, values, text=False):
+        # SafeHtml's parser keeps state between values so each run gets
+        # its own processors
+        try:
+            expected = apply_in_turn([f() for f in factories], list(values))
+        except Exception as exc:
+            with self.assertRaises(type(exc)):
+                Pipeline([f() for f in factories], text)(list(values),
+                                                          CONTEXT)
+            return
+        pipeline = Pipeline([f() for f in factories], text)
+        self.assertEqual(pipeline(list(values), CONTEXT), expected,
+                         pipeline.processors)
+
+    def test_pairs_match_processors_applied_in_turn(self):
+        for chain in chains(2):
+            self.assertSameResults(chain, VALUES)
+
+    def test_triples_match_processors_applied_in_turn(self):
+        for chain in chains(3):
+            self.assertSameResults(chain, VALUES)
+
+    def test_dates_match_processors_applied_in_turn(self):
+        for other in PROCESSORS:
+            self.assertSameResults([other, Date], VALUES)
+            self.assertSameResults([Date, other], VALUES)
+        self.assertSameResults(
+            [Text, lambda: Date('%Y-%m-%d'), Text], VALUES)
+
+    def test_text_values_match_processors_applied_in_turn(self):
+        for chain in chains(2):
+            self.assertSameResults(chain, VALUES, text=True)
+
+    def test_empty_chain_returns_values(self):
+        self.assertEqual(Pipeline([])(list(VALUES), CONTEXT), VALUES)
+
+
+def baseline_regex(pattern, values):
+    """Results of the `Regex` processor before its group fast paths."""
+    regexp = re.compile(pattern)
+    results = []
+    for value in values:
+        if isinstance(value, (dict, list)):
+            results.append(value)
+        if not value:
+            continue
+        match = regexp.search(value)
+        if not match:
+            continue
+        results.append(
+            u"".join([g for g in match.groups() or match.group() if g]))
+    return results
+
+
+class RegexTest(unittest.TestCase):
+    patterns = [r'\d+', r'(\d+)', r'(x)?\d+', r'(\d+)\D+(\d+)',
+                r'(\d+)(x)?\D+(\d+)', r'(?:a|b)', r'(?P<word>[a-z]+)']
+
+    def test_compiled_patterns_are_shared(self):
+        self.assertIs(Regex(r'(\d+)')._regexp, Regex(r'(\d+)')._regexp)
+        self.assertIs(compile_regex(r'(\d+)'), Regex(r'(\d+)')._regexp)
+
+    def test_deepcopy_reuses_compiled_pattern(self):
+        regex = Regex(re.compile(r'(\d+)', re.I))
+        copied = copy.deepcopy(regex)
+        self.assertIsNot(copied, regex)
+        self.assertIs(copied._regexp, regex._regexp)
+
+    def test_results_match_joined_groups(self):
+        values = VALUES + [u'x12 and 3', u'ab', u'12x and 3']
+        for pattern in self.patterns:
+            self.assertEqual(Regex(pattern)(list(values)),
+                             baseline_regex(pattern, values), pattern)
+
+
+class TextTest(unittest.TestCase):
+    values = VALUES + [u'a > b', u'<', u'>', u'x < y', u'\n tab\t',
+                       u'&lt;b&gt;', u'<br/>', u'caf\xe9 <i>au</i> lait']
+
+    def test_plain_text_matches_tag_stripping(self):
+        for value in self.values:
+            self.assertEqual(Text()([value]), [remove_tags(value).strip()],
+                             value)
+
+    def test_text_fields_give_the_same_values(self):
+        for chain in chains(2):
+            chain = (Text,) + chain
+            field = Field('name', '::text', [f() for f in chain], text=True)
+            untyped = Field('name', '::text', [f() for f in chain])
+            pipeline, = field.compiled_processors
+            untyped_pipeline, = untyped.compiled_processors
+            self.assertEqual(outcome(pipeline, self.values),
+                             outcome(untyped_pipeline, self.values),
+                             pipeline)
+
+
+class LazyImportTest(unittest.TestCase):
+    def test_slow_modules_are_imported_when_used(self):
+        code = ('import sys\n'
+                'import portia2code.processors as p\n'
+                'names = ("dateparser", "portia2code.parser")\n'
+                'print([n in sys.modules for n in names])\n'
+                'p.SafeHtml(); p.Date()([u"12 May 2020"])\n'
+                'print([n in sys.modules for n in names])\n')
+        output = subprocess.check_output([sys.executable, '-c', code])
+        self.assertEqual(output.split(), [b'[False,', b'False]',
+                                          b'[True,', b'True]'])
@@ -0,0 +1,382 @@
+import sys
+import unittest
+
+import attr
+import scrapy
+
+from scrapy import Request
+from scrapy.http import HtmlResponse, Response
+from twisted.internet.defer import Deferred
+
+from portia2code import spiders
+
+from portia2code.processors import Field, Item, Text
+from portia2code.spiders import (
+    BasePortiaSpider, ExtractionPool, ExtractionStats, PortiaItemBuilder,
+    RequiredFieldMissing, SeenUrls
+)
+from portia2code.starturls import FeedGenerator
+
+PAGE = b"""<html><body>
+<div class="product"><h1>Shoe</h1><span class="price">10</span></div>
+</body></html>"""
+
+
+@attr.s(slots=True)
+class AttrsItem(object):
+    title = attr.ib(default=None)
+
+
+class ListItem(scrapy.Item):
+    name = scrapy.Field()
+    products = scrapy.Field()
+
+
+class ProductItem(scrapy.Item):
+    title = scrapy.Field()
+    tags = scrapy.Field()
+
+
+class TagItem(scrapy.Item):
+    tag = scrapy.Field()
+
+
+NESTED_PAGE = b"""<html><body><ul>
+<li><h1>Shoe</h1><i>red</i><i>small</i></li>
+<li><h1>Hat</h1><i>blue</i></li>
+</ul><i>outside</i></body></html>"""
+
+
+def response(body=PAGE, url='http://example.com/'):
+    return HtmlResponse(url, body=body, encoding='utf-8')
+
+
+class PortiaItemBuilderTest(unittest.TestCase):
+    def test_undeclared_attrs_field_is_dropped(self):
+        page = response()
+        builder = PortiaItemBuilder(AttrsItem(), page.css('.product')[0],
+                                    page)
+        builder.add_css('title', 'h1::text')
+        builder.add_css('price', '.price::text')
+        item = builder.load_item()
+        self.assertEqual(item.title, ['Shoe'])
+        self.assertFalse(hasattr(item, 'price'))
+
+    def test_missing_selector_queries_response(self):
+        page = response()
+        builder = PortiaItemBuilder(AttrsItem(), None, page)
+        builder.add_css('title', 'h1::text')
+        self.assertEqual(builder.load_item().title, ['Shoe'])
+
+    def test_missing_required_field_raises(self):
+        page = response()
+        builder = PortiaItemBuilder(AttrsItem(), page.css('.product')[0],
+                                    page)
+        with self.assertRaises(RequiredFieldMissing) as raised:
+            builder.add_css('title', 'h2::text', required=True)
+        self.assertEqual(raised.exception.field, 'title')
+
+
+@attr.s(slots=True)
+class AttrsListItem(object):
+    name = attr.ib(default=None)
+
+
+class AttrsNestedSpider(BasePortiaSpider):
+    name = 'attrs_nested'
+    items = [[
+        Item(AttrsListItem, None, 'body', [
+            Field('name', 'li h1::text', [Text()]),
+            Item(ProductItem, 'products', 'li', [
+                Field('title', 'h1::text', [Text()])])])
+    ]]
+
+
+class AttrsNestedItemTest(unittest.TestCase):
+    def test_nested_items_are_dropped_with_a_warning(self):
+        PortiaItemBuilder._undeclared_fields.clear()
+        spider = AttrsNestedSpider()
+        with self.assertLogs('portia2code.spiders', 'WARNING') as logs:
+            items = list(spider.parse_item(response(NESTED_PAGE)))
+            items += list(spider.parse_item(response(NESTED_PAGE)))
+        self.assertEqual(items, [AttrsListItem(['Shoe', 'Hat'])] * 2)
+        self.assertEqual(logs.output, [
+            'WARNING:portia2code.spiders:Dropping field "products" not '
+            'declared by "AttrsListItem"'])
+
+
+class CountingBuilder(PortiaItemBuilder):
+    created = 0
+
+    def __init__(self, *args, **kwargs):
+        CountingBuilder.created += 1
+        super(CountingBuilder, self).__init__(*args, **kwargs)
+
+
+class NestedSpider(BasePortiaSpider):
+    name = 'nested'
+    loader = CountingBuilder
+    items = [[
+        Item(ListItem, None, 'body', [
+            Field('name', 'title::text', [Text()]),
+            Item(ProductItem, 'products', 'li', [
+                Field('title', 'h1::text', [Text()]),
+                Item(TagItem, 'tags', 'i', [
+                    Field('tag', '::text', [Text()])])])])
+    ]]
+
+
+class NestedItemTest(unittest.TestCase):
+    def setUp(self):
+        CountingBuilder.created = 0
+
+    def test_nested_items_are_scoped_to_parent_node(self):
+        items = list(NestedSpider().parse_item(response(NESTED_PAGE)))
+        self.assertEqual(len(items), 1)
+        products = items[0]['products']
+        self.assertEqual([p['title'] for p in products],
+                         [['Shoe'], ['Hat']])
+        self.assertEqual([[t['tag'] for t in p['tags']] for p in products],
+                         [[['red'], ['small']], [['blue']]])
+
+    def test_one_loader_per_definition(self):
+        spider = NestedSpider()
+        list(spider.parse_item(response(NESTED_PAGE)))
+        # One loader each for the list, product and tag definitions
+        self.assertEqual(CountingBuilder.created, 3)
+
+
+class Stats(object):
+    def __init__(self):
+        self.values = {}
+
+    def inc_value(self, key, count=1, start=0):
+        self.values[key] = self.values.get(key, start) + count
+
+
+class SharedSpider(BasePortiaSpider):
+    name = 'shared'
+    items = [
+        [Item(ProductItem, None, '.product', [
+            Field('title', 'h1::text', [Text()]),
+            Field('tags', '.missing::text', [Text()], required=True)])],
+        [Item(ProductItem, None, '.product', [
+            Field('title', 'h1::text', [Text()]),
+            Field('tags', '.price::text', [Text()])])],
+    ]
+
+
+class QueryReuseTest(unittest.TestCase):
+    def setUp(self):
+        self.spider = SharedSpider()
+        self.stats = Stats()
+        self.spider._extraction_stats = ExtractionStats(self.stats)
+
+    def test_queries_are_reused_between_samples(self):
+        items = list(self.spider.parse_item(response()))
+        self.assertEqual([dict(i) for i in items],
+                         [{'title': ['Shoe'], 'tags': ['10']}])
+        # The container and title queries are reused by the second sample
+        self.assertEqual(self.stats.values['portia/queries/run'], 4)
+        self.assertEqual(self.stats.values['portia/queries/reused'], 2)
+
+    def test_results_match_separate_queries(self):
+        page = response()
+        items = list(self.spider.parse_item(page))
+        definition, = self.spider.items[1]
+        separate = list(SharedSpider().load_item(definition, page))
+        self.assertEqual([dict(i) for i in items],
+                         [dict(i) for i in separate])
+
+
+class EmptyMatchSpider(BasePortiaSpider):
+    name = 'empty_match'
+    # The container matches an attribute whose value is empty
+    items = [[Item(ProductItem, None, '.product::attr(data-id)', [
+        Field('title', 'h1::text', [Text()]),
+        Field('tags', '.price *::text', [Text()], base='.price',
+              attribute='#content')])]]
+
+
+class EmptyMatchTest(unittest.TestCase):
+    def test_empty_match_is_extracted_from_response(self):
+        page = response(b"""<html><body>
+<div class="product" data-id=""><h1>Shoe</h1><span class="price">10</span>
+</div></body></html>""")
+        items = list(EmptyMatchSpider().parse_item(page))
+        self.assertEqual([dict(i) for i in items],
+                         [{'title': ['Shoe'], 'tags': ['10']}])
+
+
+class HeldPool(ExtractionPool):
+    """Pool whose extractions finish when the test fires them."""
+
+    def _submit(self, response):
+        deferred = Deferred()
+        self.submitted.append(deferred)
+        return deferred
+
+
+class ProductSpider(BasePortiaSpider):
+    name = 'products'
+    items = [[Item(ProductItem, None, '.product', [
+        Field('title', 'h1::text', [Text()])])]]
+
+
+class ExtractionPoolTest(unittest.TestCase):
+    def setUp(self):
+        if sys.version_info < (3, 7):
+            self.skipTest('Extraction workers require python 3.7')
+        self.pool = HeldPool(ProductSpider, 1, queue_size=2)
+        self.pool.submitted = []
+        self.addCleanup(self.pool.close)
+
+    def test_queue_is_bounded(self):
+        page = response()
+        first, second = self.pool.extract(page), self.pool.extract(page)
+        self.assertIsNone(self.pool.extract(page))
+        first.callback([])
+        self.assertIsNotNone(self.pool.extract(page))
+        self.assertIsNone(self.pool.extract(page))
+        second.errback(ValueError())
+        second.addErrback(lambda failure: None)
+        self.assertIsNotNone(self.pool.extract(page))
+
+    def test_full_pool_extracts_in_crawling_process(self):
+        spider = ProductSpider()
+        spider._follow_links = False
+        spider.extraction_pool = self.pool
+        page = response()
+        pooled = [spider._parse_response(page, spider.parse_item, {})
+                  for _ in range(2)]
+        self.assertTrue(all(isinstance(d, Deferred) for d in pooled))
+        items = list(spider._parse_response(page, spider.parse_item, {}))
+        self.assertEqual([dict(i) for i in items], [{'title': ['Shoe']}])
+        results = []
+        pooled[0].addCallback(results.append)
+        self.pool.submitted[0].callback(items)
+        self.assertEqual(results, [items])
+
+    def test_python_version_is_checked(self):
+        version = spiders.sys
+        self.addCleanup(setattr, spiders, 'sys', version)
+        spiders.sys = type('sys', (), {'version_info': (3, 6, 9)})
+        with self.assertRaises(ValueError):
+            ExtractionPool(ProductSpider, 1)
+
+
+class ListingSpider(BasePortiaSpider):
+    name = 'listing'
+    item_url_patterns = [r'^https?://[^/]+/product/[^/?#]+/?(?:[?#]|$)']
+
+
+class PrioritiseRequestTest(unittest.TestCase):
+    def setUp(self):
+        self.spider = ListingSpider()
+        self.spider._extraction_stats = ExtractionStats(Stats())
+
+    def test_item_pages_are_prioritised(self):
+        request = self.spider.prioritise_request(
+            Request('http://example.com/product/shoe', priority=1))
+        self.assertEqual(request.priority,
+                         1 + self.spider.item_page_priority)
+
+    def test_other_pages_keep_their_priority(self):
+        for url in ('http://example.com/product/', 'http://example.com/',
+                    'http://example.com/product/shoe/reviews'):
+            request = self.spider.prioritise_request(
+                Request(url, priority=1))
+            self.assertEqual(request.priority, 1, url)
+
+    def test_requests_are_counted(self):
+        for url in ('http://example.com/product/shoe',
+                    'http://example.com/product/hat?colour=red',
+                    'http://example.com/about'):
+            self.spider.prioritise_request(Request(url))
+        self.assertEqual(self.spider.extraction_stats.stats.values, {
+            'portia/requests/item_pages': 2,
+            'portia/requests/other_pages': 1})
+
+    def test_no_patterns(self):
+        spider = BasePortiaSpider(name='plain')
+        request = Request('http://example.com/product/shoe')
+        self.assertIs(spider.prioritise_request(request), request)
+
+
+class MarkedSpider(ProductSpider):
+    name = 'marked'
+    page_marker = ("descendant-or-self::*[@class and contains(concat("
+                   "' ', normalize-space(@class), ' '), ' product ')]")
+
+
+class SkipResponseTest(unittest.TestCase):
+    def setUp(self):
+        self.spider = MarkedSpider()
+        self.stats = Stats()
+        self.spider._extraction_stats = ExtractionStats(self.stats)
+
+    def test_pages_without_marker_are_skipped(self):
+        page = response(b'<html><body><h1>About</h1></body></html>')
+        self.assertEqual(self.spider.skip_response(page), 'no_marker')
+        self.assertEqual(list(self.spider.parse_item(page)), [])
+        self.assertEqual(self.stats.values,
+                         {'portia/pages/skipped/no_marker': 1})
+
+    def test_pages_with_marker_are_parsed(self):
+        page = response()
+        self.assertIsNone(self.spider.skip_response(page))
+        items = list(self.spider.parse_item(page))
+        self.assertEqual([dict(i) for i in items], [{'title': ['Shoe']}])
+        self.assertNotIn('portia/pages/skipped/no_marker', self.stats.values)
+
+    def test_responses_without_text_are_skipped(self):
+        page = Response('http://example.com/shoe.jpg', body=PAGE)
+        self.assertEqual(self.spider.skip_response(page), 'not_text')
+        self.assertEqual(list(self.spider.parse_item(page)), [])
+        self.assertEqual(self.stats.values,
+                         {'portia/pages/skipped/not_text': 1})
+
+    def test_no_marker(self):
+        page = response(b'<html><body><h1>About</h1></body></html>')
+        self.assertIsNone(ProductSpider().skip_response(page))
+
+
+class SeenUrlsTest(unittest.TestCase):
+    def test_urls_are_added_once(self):
+        seen = SeenUrls()
+        self.assertTrue(seen.add('http://example.com/1'))
+        self.assertTrue(seen.add(u'http://example.com/2'))
+        self.assertFalse(seen.add('http://example.com/1'))
+        self.assertFalse(seen.add(u'http://example.com/2'))
+        self.assertEqual(len(seen), 2)
+
+
+class StartUrlsSpider(BasePortiaSpider):
+    name = 'start_urls'
+    start_urls = [
+        'http://example.com/shoes1',
+        {'type': 'generated', 'url': 'http://example.com/[shoes hats][1-2]',
+         'fragments': [{'type': 'fixed', 'value': 'http://example.com/'},
+                       {'type': 'list', 'value': 'shoes hats'},
+                       {'type': 'range', 'value': '1-2'}]},
+        {'type': 'feed', 'url': 'http://example.com/feed'},
+        'http://example.com/hats2',
+        'http://example.com/bags1',
+    ]
+
+
+class StartRequestsTest(unittest.TestCase):
+    def test_duplicate_urls_are_requested_once(self):
+        requests = list(StartUrlsSpider().start_requests())
+        self.assertEqual([r.url for r in requests], [
+            'http://example.com/shoes1', 'http://example.com/shoes2',
+            'http://example.com/hats1', 'http://example.com/hats2',
+            'http://example.com/feed', 'http://example.com/bags1'])
+
+    def test_feed_urls_skip_start_urls(self):
+        spider = StartUrlsSpider()
+        feed = list(spider.start_requests())[4]
+        self.assertEqual(feed.callback.__func__, FeedGenerator.parse_urls)
+        body = b'http://example.com/bags1\nhttp://example.com/bags2'
+        urls = feed.callback(response(body, feed.url))
+        self.assertEqual([r.url for r in urls], ['http://example.com/bags2'])
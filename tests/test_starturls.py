@@ -0,0 +1,83 @@
+import unittest
+
+from scrapy.http import TextResponse
+from slybot.starturls import FragmentGenerator as SlybotFragmentGenerator
+
+from portia2code.spiders import SeenUrls
+from portia2code.starturls import FeedGenerator, FragmentGenerator
+
+
+def spec(*fragments):
+    return {'fragments': [{'type': t, 'value': v} for t, v in fragments]}
+
+
+SPECS = [
+    spec(('fixed', 'http://example.com/'), ('list', 'shoes hats bags'),
+         ('fixed', '?page='), ('range', '1-12')),
+    spec(('fixed', 'http://example.com/'), ('range', 'a-e'),
+         ('fixed', '/'), ('range', '8-11'), ('list', 'x y')),
+    spec(('fixed', 'http://example.com/'), ('range', 'C-A')),
+    spec(('fixed', 'http://example.com/'), ('date', '%Y'),
+         ('list', 'a'), ('range', '0-0')),
+]
+
+
+class FragmentGeneratorTest(unittest.TestCase):
+    def test_same_urls_in_same_order_as_slybot(self):
+        for url_spec in SPECS:
+            self.assertEqual(list(FragmentGenerator()(url_spec)),
+                             list(SlybotFragmentGenerator()(url_spec)))
+
+    def test_last_fragment_changes_fastest(self):
+        urls = FragmentGenerator()(spec(
+            ('fixed', 'http://example.com/'), ('list', 'a b'),
+            ('range', '1-2')))
+        self.assertEqual(list(urls), [
+            'http://example.com/a1', 'http://example.com/a2',
+            'http://example.com/b1', 'http://example.com/b2'])
+
+    def test_urls_are_generated_as_needed(self):
+        urls = FragmentGenerator()(spec(
+            ('fixed', 'http://example.com/'), ('range', '1-1000000000'),
+            ('range', '1-1000000000')))
+        self.assertEqual(next(urls), 'http://example.com/11')
+        self.assertEqual(next(urls), 'http://example.com/12')
+
+    def test_unknown_fragment_type(self):
+        with self.assertRaises(ValueError):
+            FragmentGenerator()(spec(('pattern', 'a')))
+
+
+class FeedGeneratorTest(unittest.TestCase):
+    def parse(self, response):
+        pass
+
+    def feed(self, body):
+        return TextResponse('http://example.com/feed', body=body,
+                            encoding='utf-8')
+
+    def test_feed_is_requested(self):
+        request = FeedGenerator(self.parse)('http://example.com/feed')
+        self.assertEqual(request.url, 'http://example.com/feed')
+        self.assertEqual(request.callback.__func__,
+                         FeedGenerator.parse_urls)
+
+    def test_every_line_is_requested(self):
+        generator = FeedGenerator(self.parse)
+        requests = list(generator.parse_urls(self.feed(
+            b'http://example.com/1\r\nhttp://example.com/2\n\n'
+            b'http://example.com/1')))
+        self.assertEqual([r.url for r in requests], [
+            'http://example.com/1', 'http://example.com/2',
+            'http://example.com/1'])
+        self.assertTrue(all(r.callback == self.parse for r in requests))
+
+    def test_seen_urls_are_skipped(self):
+        seen = SeenUrls()
+        seen.add('http://example.com/2')
+        generator = FeedGenerator(self.parse, seen)
+        requests = generator.parse_urls(self.feed(
+            b'http://example.com/1\nhttp://example.com/2\n'
+            b'http://example.com/1\nhttp://example.com/3'))
+        self.assertEqual([r.url for r in requests], [
+            'http://example.com/1', 'http://example.com/3'])
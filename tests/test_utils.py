@@ -0,0 +1,171 @@
+import re
+import unittest
+
+from collections import deque
+
+from cssselect import ExpressionError
+from parsel import Selector
+from scrapy.http import HtmlResponse
+from scrapy.linkextractors import LinkExtractor
+
+from portia2code.utils import (
+    Item, build_container_query, build_container_tests, container_test,
+    learn_link_patterns
+)
+
+SHOP = 'http://shop.example.com'
+NEWS = 'http://news.example.com'
+NAVIGATION = ['/', '/about', '/help/', '/help/delivery', '/blog/']
+
+
+def shop_site():
+    """Pages of a shop with products in `/products/` and a large blog."""
+    products = ['/products/shirt-%d' % i for i in range(20)]
+    posts = ['/blog/2020/post-%d' % i for i in range(60)]
+    site = {'/products/': products[:10] + ['/products/?page=2'],
+            '/products/?page=2': products[10:] + ['/products/']}
+    for path in products:
+        site[path] = ['/products/', '/products/reviews/' + path[10:]]
+        site['/products/reviews/' + path[10:]] = [path]
+    for i, path in enumerate(posts):
+        site[path] = posts[i + 1:i + 4] + ['/blog/']
+    site['/blog/'] = posts[:10]
+    for path in NAVIGATION:
+        site.setdefault(path, [])
+    for links in site.values():
+        links.extend(NAVIGATION)
+    return site, products
+
+
+def news_site():
+    """Pages of a news site with stories in a section for each year."""
+    stories = ['/%d/story-%d' % (year, i)
+               for year in range(2015, 2021) for i in range(5)]
+    site = {'/latest/': stories[-5:] + ['/archive/'],
+            '/archive/': ['/%d/' % y for y in range(2015, 2021)]}
+    for year in range(2015, 2021):
+        site['/%d/' % year] = [s for s in stories
+                               if s.startswith('/%d/' % year)]
+    for i, story in enumerate(stories):
+        # Link to the previous story, which may be in another section
+        site[story] = stories[max(i - 1, 0):i] + [
+            '/latest/', '/tags/%s/related' % story[1:5]]
+        site['/tags/%s/related' % story[1:5]] = ['/latest/']
+    return site, stories
+
+
+def crawl(site, domain, start, link_extractor):
+    """Crawl `site` from `start`, returning the urls requested."""
+    seen, requested = {start}, []
+    queue = deque([start])
+    while queue:
+        url = queue.popleft()
+        requested.append(url)
+        links = site.get(url[len(domain):], [])
+        body = u''.join(u'<a href="%s">link</a>' % l for l in links)
+        response = HtmlResponse(url, body=body, encoding='utf-8')
+        for link in link_extractor.extract_links(response):
+            if link.url not in seen and link.url.startswith(domain):
+                seen.add(link.url)
+                queue.append(link.url)
+    return requested
+
+
+class LearnLinkPatternsTest(unittest.TestCase):
+    def assertMoreItemsPerRequest(self, site, domain, start, samples,
+                                  items):
+        allow, deny = learn_link_patterns([domain + s for s in samples],
+                                          [domain + start])
+        learned = crawl(site, domain, domain + start,
+                        LinkExtractor(allow=allow, deny=deny))
+        everything = crawl(site, domain, domain + start, LinkExtractor())
+        items = {domain + i for i in items}
+        self.assertEqual(items - set(learned), set())
+        self.assertEqual(items - set(everything), set())
+        self.assertLess(len(learned), len(everything))
+        return allow, deny
+
+    def test_sections_of_samples_and_start_urls(self):
+        site, products = shop_site()
+        allow, deny = self.assertMoreItemsPerRequest(
+            site, SHOP, '/products/', ['/products/shirt-3'], products)
+        self.assertEqual(allow, [r'^https?://[^/]+/products(?:[/?#]|$)'])
+        self.assertEqual(deny, [r'^https?://[^/]+(?:/[^/?#]+){4,}'])
+
+    def test_shape_of_samples_in_varying_sections(self):
+        site, stories = news_site()
+        allow, _ = self.assertMoreItemsPerRequest(
+            site, NEWS, '/latest/', ['/2020/story-1'], stories)
+        self.assertEqual(allow, [
+            r'^https?://[^/]+/[^/?#]+/[^/?#]+/?(?:[?#]|$)',
+            r'^https?://[^/]+/latest(?:[/?#]|$)'])
+
+    def test_home_page_start_url_allows_any_section(self):
+        allow, _ = learn_link_patterns([SHOP + '/products/shirt-3'],
+                                       [SHOP + '/'])
+        self.assertEqual(allow, ['.*'])
+
+    def test_no_samples(self):
+        self.assertEqual(learn_link_patterns([], [SHOP + '/products/']),
+                         ([], []))
+
+    def test_links_too_deep_are_denied(self):
+        _, deny = learn_link_patterns([SHOP + '/products/shirt-3'],
+                                      [SHOP + '/products/'])
+        regex = re.compile(deny[0])
+        self.assertFalse(regex.search(SHOP + '/products/reviews/shirt-3'))
+        self.assertTrue(regex.search(SHOP + '/products/a/b/c'))
+
+
+CONTAINER_PAGE = u'''
+<html><body>
+<div id="a" class="list wide"><ul><li class="x">1</li><li>2</li>
+<li class="x y"><span>3</span></li></ul></div>
+<div id="b"><p lang="en-GB">p1</p><p>p2 <a href="/x">link</a></p>
+<table><tr><td>c1</td><td class="price">c2</td></tr></table></div>
+<section><h2>head</h2><p class="intro">intro</p><p>body</p></section>
+<form><input type="checkbox" checked><input type="text" disabled></form>
+</body></html>
+'''
+CONTAINER_SELECTORS = [
+    'div', 'DIV#b', 'LI.X', 'li.x', '#a', '.list.wide', 'ul > li',
+    'div li', 'div > ul li.y', 'h2 + p', 'h2 ~ p', 'td + td.price',
+    'p[lang|=en]', 'a[href^="/"]', 'div:first-child', 'li:nth-child(2)',
+    'li:last-child', 'p:not(.intro)', 'section p', 'table td, ul > li',
+    'input:checked', 'input:disabled', '*', 'div:nth-of-type(2)',
+    'li:first-of-type', 'p:only-child', 'span:empty', 'TD',
+]
+
+
+class ContainerTestTest(unittest.TestCase):
+    def test_matches_the_same_nodes_as_css(self):
+        selector = Selector(text=CONTAINER_PAGE)
+        tree = selector.root.getroottree()
+        for css in CONTAINER_SELECTORS:
+            query = 'descendant-or-self::*[{}]'.format(container_test(css))
+            self.assertEqual(
+                [tree.getpath(s.root) for s in selector.xpath(query)],
+                [tree.getpath(s.root) for s in selector.css(css)], css)
+
+    def test_query_finds_containers_of_every_sample(self):
+        selector = Selector(text=CONTAINER_PAGE)
+        tree = selector.root.getroottree()
+        samples = [[Item(None, None, css, [])]
+                   for css in CONTAINER_SELECTORS if css != '*']
+        self.assertIsNotNone(build_container_tests(samples))
+        expected = set()
+        for css in CONTAINER_SELECTORS:
+            if css != '*':
+                expected.update(tree.getpath(s.root)
+                                for s in selector.css(css))
+        found = [tree.getpath(s.root)
+                 for s in selector.xpath(build_container_query(samples))]
+        self.assertEqual(sorted(found), sorted(expected))
+        self.assertEqual(len(found), len(expected))
+
+    def test_element_names_are_lowercased(self):
+        self.assertEqual(container_test('DIV#b'), container_test('div#b'))
+
+    def test_pseudo_elements_cannot_be_tested(self):
+        with self.assertRaises(ExpressionError):
+            container_test('p::text')
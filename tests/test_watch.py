@@ -0,0 +1,44 @@
+import unittest
+
+from portia2code.utils import class_name
+from portia2code.watch import ProjectWatcher
+
+
+class FailingWatcher(ProjectWatcher):
+    """Watcher that fails to port its first change."""
+
+    def __init__(self, changes):
+        super(FailingWatcher, self).__init__('project', 'out', 'my_shop', 0)
+        self.changes = changes
+        self.updates = []
+
+    def port_all(self):
+        pass
+
+    def poll(self):
+        return self.changes.pop(0)
+
+    def update(self, changed):
+        self.updates.append(set(changed))
+        if len(self.updates) == 1:
+            raise RuntimeError('Failed to port')
+        if not self.changes:
+            raise KeyboardInterrupt
+        return changed
+
+
+class ProjectWatcherTest(unittest.TestCase):
+    def test_project_name_is_cleaned_once(self):
+        watcher = ProjectWatcher('project', 'out', 'my_shop')
+        self.assertEqual(watcher.dir_name, 'my_shop')
+        self.assertEqual(watcher._path('items.py'),
+                         '{}/items.py'.format(class_name('my_shop')))
+
+    def test_failed_changes_are_retried(self):
+        watcher = FailingWatcher([{'items.json'}, set(),
+                                  {'spiders/a.json'}, {'spiders/b.json'}])
+        with self.assertRaises(KeyboardInterrupt):
+            watcher.run()
+        self.assertEqual(watcher.updates, [
+            {'items.json'}, {'items.json', 'spiders/a.json'},
+            {'spiders/b.json'}])